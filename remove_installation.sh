@@ -154,6 +154,13 @@ if [ -n "$CUSTOM_DOWNLOAD_PATH" ] && [ "$CUSTOM_DOWNLOAD_PATH" != "$ZIP_FILE" ]
     echo "Removing custom ZIP: $CUSTOM_DOWNLOAD_PATH"
     rm -f "$CUSTOM_DOWNLOAD_PATH"
 fi
+# Partial downloads kept for resuming
+for zip in "$ZIP_FILE" "$CUSTOM_DOWNLOAD_PATH"; do
+    if [ -n "$zip" ] && [ -f "$zip.part" ]; then
+        echo "Removing partial download: $zip.part"
+        rm -f "$zip.part" "$zip.part.json"
+    fi
+done
 
 # Handle target directories
 handle_target_removal() {
@@ -6,14 +6,14 @@ Dropbox ZIP Mirror Sync Script
 ==============================
 
 This script downloads a Dropbox ZIP file (public link with ?dl=1),
-extracts it safely, compares files via SHA256, and syncs the contents
+extracts it safely, compares files via digests, and syncs the contents
 into a local target directory.
 
 Main features:
 --------------
 - Downloads ZIP from Dropbox with dynamic progress bar (like apt)
 - Extracts ZIP safely with protection against path traversal
-- Compares files via SHA256 to avoid unnecessary writes
+- Compares files via SHA256 (or a faster digest, see DIGEST_ALGO) to avoid unnecessary writes
 - Copies new files, updates changed files, and optionally archives old versions
 - Logs every action to a log file
 - Interactive setup for first run (if config is missing)
@@ -29,23 +29,118 @@ Typical use:
 
 import os
 import sys
+import json
+import argparse
+import sqlite3
 import shutil
 import hashlib
 import zipfile
 import tempfile
 import re
+import fnmatch
+import posixpath
+import struct
+import zlib
+import threading
+import errno
+import queue
+import gzip
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_EXCEPTION, FIRST_COMPLETED
+from dataclasses import dataclass
 from pathlib import Path
 from datetime import datetime
 from urllib.parse import urlparse
 import requests
 import time
 
+# Optional faster digest backends (see DIGEST_ALGO)
+try:
+    import fcntl
+except ImportError:  # Not on Windows
+    fcntl = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+# Optional codecs for VERSIONS_COMPRESS
+try:
+    import lzma
+except ImportError:  # Python built without liblzma
+    lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # ------------------ Config paths ------------------
 script_dir = Path(__file__).parent
 ENV_PATH = script_dir / ".dropbox_mirror.env"
 if not ENV_PATH.exists():
     ENV_PATH = Path.home() / ".dropbox_mirror.env"
 
+# Per-mirror state lives inside the target so that wiping the mirror also
+# forgets everything remembered about it (and forces a full sync).
+STATE_DIRNAME = ".mirror_state"
+REMOTE_STATE_FILE = "remote.json"
+STATE_DB_FILE = "state.db"
+VERSIONS_DIRNAME = ".old_versions"
+# files: timestamped copies next to each other; objects: content-addressed store
+VERSIONS_STORES = ("files", "objects")
+VERSIONS_INDEX_FILE = "index.db"
+OBJECT_DIGEST = "sha256"  # Object names must be collision-resistant
+# Entries of TARGET_DIR that belong to the mirror itself, not to Dropbox
+MIRROR_INTERNAL = (VERSIONS_DIRNAME, STATE_DIRNAME)
+
+# extract: download, extract to a temp dir, hash-compare and copy (default)
+# zip:     download, diff via the ZIP central directory, inflate changes only
+# stream:  sync members while the ZIP is still downloading
+SYNC_MODES = ("extract", "zip", "stream")
+# Where extract mode inflates members: next to their target file (renamed
+# into place when changed) or into a temp dir that is then copied over
+STAGING_MODES = ("target", "tempdir")
+# none: leave flushing to the OS; batch: fsync written files and their
+# directories in groups; strict: fsync each file and its directory
+DURABILITY_MODES = ("none", "batch", "strict")
+# What happens to mirrored files that are no longer in the ZIP
+DELETE_MODES = ("keep", "archive", "delete")
+TOMBSTONES_FILE = "tombstones.json"
+JOURNAL_FILE = "journal.jsonl"  # Write-ahead log of file replacements
+RESUME_FILE = "resume.json"  # Kept ZIP and position of a run stopped by MAX_RUNTIME
+# auto: redrawn bar on a terminal, periodic plain lines otherwise
+PROGRESS_MODES = ("auto", "bar", "plain", "off")
+
+# hash:         compare content of every file that exists on both sides
+# quick:        same size and mtime = unchanged, different mtime = changed
+# quick+verify: same size and mtime = unchanged, different mtime = compare content
+COMPARE_MODES = ("hash", "quick", "quick+verify")
+# ZIP (DOS) timestamps and FAT/exFAT SD cards only have 2 second resolution
+MTIME_WINDOW = 2
+
+@dataclass
+class SyncOptions:
+    """Settings that control how ZIP contents are applied to TARGET_DIR."""
+    keep_versions: bool = True
+    dry_run: bool = False
+    workers: int = 1
+    compare_mode: str = "hash"
+    digest: str = "sha256"
+    durability: str = "none"
+    queue_chunks: int = 64
+    delete_mode: str = "keep"
+    delete_exclude: tuple = ()
+    delete_max_percent: int = 50
+    detect_moves: bool = True
+
+    @property
+    def fsync(self):
+        """Whether every written file is fsynced before it is renamed into place."""
+        return self.durability == "strict"
+
 # ------------------ Helpers ------------------
 ANSI_RE = re.compile(r'\x1B[@-_][0-?]*[ -/]*[@-~]')
 C0_RE = re.compile(r'[\x00-\x1F\x7F]')  # Control characters
@@ -75,6 +170,25 @@ def read_env(path=ENV_PATH):
         print(f"Warning: Could not read config file {path}: {e}", flush=True)
     return d
 
+def cfg_value(cfg, key, default=""):
+    """Config value without a trailing inline comment (`KEY=value  # note`)."""
+    v = cfg.get(key)
+    if v is None:
+        return default
+    v = re.split(r"\s+#", v, 1)[0].strip()
+    return v if v else default
+
+def cfg_int(cfg, key, default, minimum=None):
+    """Integer config value; falls back to `default` if unset or invalid."""
+    try:
+        n = int(cfg_value(cfg, key, default))
+    except (TypeError, ValueError):
+        print(f"Warning: invalid {key}={cfg.get(key)!r}, using {default}", flush=True)
+        n = default
+    if minimum is not None:
+        n = max(minimum, n)
+    return n
+
 def ask(prompt, default=None):
     """Ask user interactively (used in first-time setup)."""
     if default:
@@ -88,20 +202,382 @@ def timestamp(fmt="%Y-%m-%d %H:%M:%S"):
 
 def ensure_dir(p):
     """Ensure a directory exists (mkdir -p equivalent)."""
-    Path(p).mkdir(parents=True, exist_ok=True)
+    KNOWN_DIRS.ensure(p)
+
+class DirCache:
+    """Directories known to exist during this run, so ensure_dir() skips repeated mkdirs."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._known = set()
+
+    def ensure(self, p):
+        p = os.fspath(p)
+        if p in self._known:
+            return
+        Path(p).mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            # mkdir -p also guarantees every ancestor
+            while p not in self._known:
+                self._known.add(p)
+                parent = os.path.dirname(p)
+                if parent == p:
+                    break
+                p = parent
+
+    def prepare(self, root, names):
+        """Create the directories of all member `names` below `root` in one pass.
+
+        The directory set is derived from the names alone and created in
+        sorted order, so each mkdir only needs its parent from the line before.
+        """
+        dirs = set()
+        for name in names:
+            parent = posixpath.dirname(name)
+            while parent and parent not in dirs:
+                dirs.add(parent)
+                parent = posixpath.dirname(parent)
+        self.ensure(root)
+        root = os.fspath(root)
+        for rel in sorted(dirs):
+            path = os.path.join(root, rel)
+            if path in self._known:
+                continue
+            try:
+                os.mkdir(path)
+            except FileExistsError:
+                pass
+            with self._lock:
+                self._known.add(path)
+
+    def forget(self, p):
+        with self._lock:
+            self._known.discard(os.fspath(p))
+
+    def reset(self):
+        with self._lock:
+            self._known.clear()
+
+KNOWN_DIRS = DirCache()
+
+class IOStats:
+    """Bytes read from and written to local files during a run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.read = self.written = 0
+
+    def add(self, read=0, written=0):
+        with self._lock:
+            self.read += read
+            self.written += written
+
+    def reset(self):
+        with self._lock:
+            self.read = self.written = 0
+
+IO_STATS = IOStats()
+
+class FsyncBatch:
+    """Times every fsync of a run and batches them for DURABILITY=batch.
+
+    In batch mode, commit_staged hands over each file it renamed into
+    place; every `batch_files` files (and at flush()) they are fsynced,
+    followed by each of their directories once. Other modes ignore add().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.mode = "none"
+        self.batch_files = 64
+        self.pending = []
+        self.calls = 0
+        self.seconds = 0.0
+
+    def configure(self, mode, batch_files=64):
+        self.mode = mode
+        self.batch_files = batch_files
+
+    def reset(self):
+        with self._lock:
+            self.pending = []
+            self.calls = 0
+            self.seconds = 0.0
 
-def sha256_file(path):
-    """Compute SHA256 hash of file to detect changes."""
-    h = hashlib.sha256()
+    def fsync(self, fd):
+        """os.fsync, timed."""
+        start = time.perf_counter()
+        try:
+            os.fsync(fd)
+        finally:
+            with self._lock:
+                self.calls += 1
+                self.seconds += time.perf_counter() - start
+
+    def fsync_path(self, path):
+        """Fsync a file or directory by path; not every FS supports it for dirs."""
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            self.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def add(self, path):
+        if self.mode != "batch":
+            return
+        with self._lock:
+            self.pending.append(path)
+            if len(self.pending) < self.batch_files:
+                return
+            batch, self.pending = self.pending, []
+        self._sync(batch)
+
+    def flush(self):
+        """Checkpoint: persist every file handed over so far."""
+        with self._lock:
+            batch, self.pending = self.pending, []
+        self._sync(batch)
+
+    def _sync(self, batch):
+        for path in batch:
+            self.fsync_path(path)
+        for parent in dict.fromkeys(Path(path).parent for path in batch):
+            self.fsync_path(parent)
+
+    def summary(self):
+        return f"{self.calls} calls, {self.seconds:.2f} s ({self.mode})"
+
+FSYNCS = FsyncBatch()
+
+class BudgetExhausted(Exception):
+    """A time budget ran out in a step that saves its own progress (download, compression)."""
+
+class RunBudget:
+    """Wall-clock budget of a run (MAX_RUNTIME); unlimited unless configured.
+
+    Work stops while a reserve (10%, at most 30 s) is still left, so the
+    run has time to check its progress into the state dir.
+    """
+
+    def __init__(self):
+        self.deadline = None
+
+    def configure(self, seconds):
+        self.deadline = None
+        if seconds:
+            self.deadline = time.monotonic() + seconds - min(30, seconds * 0.1)
+
+    @property
+    def enabled(self):
+        return self.deadline is not None
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def remaining(self):
+        return None if self.deadline is None else max(0, self.deadline - time.monotonic())
+
+    def check(self):
+        if self.expired():
+            raise BudgetExhausted("MAX_RUNTIME used up")
+
+    def take(self, items):
+        """Yield `items` until the budget runs out."""
+        for item in items:
+            if self.expired():
+                return
+            yield item
+
+BUDGET = RunBudget()
+
+# ------------------ Digest backends ------------------
+class Crc32Hash:
+    """hashlib-style wrapper around zlib.crc32, the checksum ZIP headers use."""
+
+    def __init__(self):
+        self._crc = 0
+
+    def update(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+
+    def hexdigest(self):
+        return f"{self._crc:08x}"
+
+# Digests only detect changes, they do not need to be cryptographic. The
+# algorithm name is stored next to every persisted digest.
+DIGEST_BACKENDS = {
+    "sha256": hashlib.sha256,
+    "blake2b": hashlib.blake2b,
+    "crc32": Crc32Hash,
+}
+if xxhash is not None:
+    DIGEST_BACKENDS["xxhash"] = xxhash.xxh3_64
+if blake3 is not None:
+    DIGEST_BACKENDS["blake3"] = blake3.blake3
+# Backends that need an extra package: name -> pip package
+OPTIONAL_DIGESTS = {"xxhash": "xxhash", "blake3": "blake3"}
+
+def new_hasher(algo):
+    """Return a fresh hashlib-style object for a DIGEST_BACKENDS name."""
+    return DIGEST_BACKENDS[algo]()
+
+def hash_file(path, algo="sha256"):
+    """Compute the digest of a file to detect changes (None on read errors)."""
+    h = new_hasher(algo)
     try:
         with open(path, "rb") as f:
             for chunk in iter(lambda: f.read(1024*1024), b""):
                 h.update(chunk)
+                IO_STATS.add(read=len(chunk))
         return h.hexdigest()
-    except Exception as e:
+    except OSError as e:
         print(f"Error hashing file {path}: {e}", flush=True)
         return None
 
+def copy_file_hashed(src, dest, algo="sha256", fsync=False):
+    """Copy a file like shutil.copy2 and return its digest from the same pass."""
+    h = new_hasher(algo)
+    bufsize = COPIER.buffer_size
+    with open(src, "rb") as fin, open(dest, "wb") as fout:
+        for chunk in iter(lambda: fin.read(bufsize), b""):
+            h.update(chunk)
+            fout.write(chunk)
+            IO_STATS.add(read=len(chunk), written=len(chunk))
+        if fsync:
+            fout.flush()
+            FSYNCS.fsync(fout.fileno())
+    shutil.copystat(src, dest)
+    COPIER.record("buffered+hash")
+    return h.hexdigest()
+
+# ------------------ Copy backends ------------------
+FICLONE = 0x40049409  # ioctl from linux/fs.h
+COPY_METHODS = ("reflink", "copy_file_range", "sendfile", "buffered")
+# Errors meaning "this method does not work here", not "the copy failed"
+COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF, errno.EPERM,
+                        errno.ENOTTY, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+def _copy_reflink(fin, fout, size, bufsize):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "reflinks need fcntl")
+    fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+
+def _copy_file_range(fin, fout, size, bufsize):
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "os.copy_file_range is unavailable")
+    done = 0
+    while done < size:
+        n = os.copy_file_range(fin.fileno(), fout.fileno(), size - done)
+        if n == 0:
+            break
+        done += n
+        IO_STATS.add(read=n, written=n)
+    if done != size:
+        raise IOError(f"copy_file_range stopped after {done} of {size} bytes")
+
+def _copy_sendfile(fin, fout, size, bufsize):
+    if not hasattr(os, "sendfile"):
+        raise OSError(errno.ENOSYS, "os.sendfile is unavailable")
+    done = 0
+    while done < size:
+        n = os.sendfile(fout.fileno(), fin.fileno(), done, size - done)
+        if n == 0:
+            break
+        done += n
+        IO_STATS.add(read=n, written=n)
+    if done != size:
+        raise IOError(f"sendfile stopped after {done} of {size} bytes")
+
+def _copy_buffered(fin, fout, size, bufsize):
+    for chunk in iter(lambda: fin.read(bufsize), b""):
+        fout.write(chunk)
+        IO_STATS.add(read=len(chunk), written=len(chunk))
+
+COPY_BACKENDS = {
+    "reflink": _copy_reflink,
+    "copy_file_range": _copy_file_range,
+    "sendfile": _copy_sendfile,
+    "buffered": _copy_buffered,
+}
+
+class FileCopier:
+    """Copy file contents with the cheapest COPY_METHODS entry the filesystems allow.
+
+    An unsupported method is skipped for the rest of the run; `used` counts files per method.
+    """
+
+    def __init__(self, method="auto", buffer_size=1024 * 1024):
+        self._lock = threading.Lock()
+        self.configure(method, buffer_size)
+
+    def configure(self, method="auto", buffer_size=1024 * 1024):
+        first = 0 if method == "auto" else COPY_METHODS.index(method)
+        self.chain = COPY_METHODS[first:]
+        self.buffer_size = buffer_size
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.unsupported = set()
+            self.used = {}
+
+    def record(self, method):
+        with self._lock:
+            self.used[method] = self.used.get(method, 0) + 1
+
+    def copy(self, src, dest, fsync=False):
+        """Copy `src` to `dest` like shutil.copy2; return the method used."""
+        with open(src, "rb") as fin, open(dest, "wb") as fout:
+            size = os.fstat(fin.fileno()).st_size
+            for method in self.chain:
+                if method in self.unsupported:
+                    continue
+                try:
+                    COPY_BACKENDS[method](fin, fout, size, self.buffer_size)
+                    break
+                except OSError as e:
+                    if method == "buffered" or e.errno not in COPY_FALLBACK_ERRNOS:
+                        raise
+                    with self._lock:
+                        self.unsupported.add(method)
+                    # Start over cleanly with the next method.
+                    fin.seek(0)
+                    fout.seek(0)
+                    fout.truncate()
+            if fsync:
+                fout.flush()
+                FSYNCS.fsync(fout.fileno())
+        shutil.copystat(src, dest)
+        self.record(method)
+        return method
+
+    def summary(self):
+        return ", ".join(f"{m} ({n} files)" for m, n in sorted(self.used.items())) or "none"
+
+COPIER = FileCopier()
+
+def digest_benchmark(size_mb=64):
+    """Print the throughput of every digest backend on this device."""
+    block = os.urandom(1024 * 1024)
+    print(f"⏱️  Hashing {size_mb} MB per backend (in memory, disk I/O excluded)", flush=True)
+    for algo in DIGEST_BACKENDS:
+        h = new_hasher(algo)
+        start = time.perf_counter()
+        for _ in range(size_mb):
+            h.update(block)
+        h.hexdigest()
+        elapsed = time.perf_counter() - start
+        print(f"   {algo:8}: {size_mb / elapsed:8.1f} MB/s", flush=True)
+    for algo, package in OPTIONAL_DIGESTS.items():
+        if algo not in DIGEST_BACKENDS:
+            print(f"   {algo:8}: not installed (pip install {package})", flush=True)
+    return 0
+
 def is_interactive():
     """Check if running interactively (not Termux widget)."""
     return sys.stdin.isatty() and os.environ.get("TERMUX_WIDGET") != "1"
@@ -118,20 +594,128 @@ def validate_url(u: str) -> bool:
     except Exception:
         return False
 
-def print_progress_bar(current, total, prefix="", length=40, speed=None, eta=None):
-    """Print apt-like progress bar dynamically in one line."""
-    percent = current / total if total else 0
-    filled_length = int(length * percent)
-    bar = "█" * filled_length + "░" * (length - filled_length)
-    extra = ""
-    if speed is not None:
-        extra += f" | {speed/1024:.1f} KB/s"
-    if eta is not None:
-        extra += f" | ETA {int(eta)}s"
-    sys.stdout.write(f"\r{prefix:12} |{bar}| {percent*100:6.2f}%{extra}")
-    sys.stdout.flush()
-    if current >= total:
-        sys.stdout.write("\n")
+class ProgressRenderer:
+    """Throttled apt-like progress: a bar on a TTY, a line every PLAIN_INTERVAL otherwise."""
+    PLAIN_INTERVAL = 10.0
+
+    def __init__(self, mode="auto", rate=4.0, stream=None):
+        self._lock = threading.Lock()
+        self.stream = stream or sys.stdout
+        self.configure(mode, rate)
+        self.plan([])
+        self._phase = None
+
+    def configure(self, mode="auto", rate=4.0):
+        if mode == "auto":
+            mode = "bar" if self.stream.isatty() else "plain"
+        self.mode = mode
+        self.min_interval = 1.0 / rate if rate > 0 else 0.0
+
+    def plan(self, phases):
+        """Declare the phases of this run, for the overall position and ETA."""
+        self.phases = list(phases)
+        self.run_start = time.monotonic()
+
+    def start(self, name, total, unit="files", initial=0):
+        """Begin a phase of `total` units (`unit` is "files" or "bytes")."""
+        with self._lock:
+            now = time.monotonic()
+            self._phase = {"name": name, "total": total, "unit": unit, "current": initial,
+                           "initial": initial, "start": now, "drawn": 0.0, "width": 0}
+            if self.mode == "plain":
+                self._phase["drawn"] = now
+
+    def update(self, current):
+        """Report progress; redraws only if the throttle interval has passed."""
+        with self._lock:
+            ph = self._phase
+            if ph is None:
+                return
+            ph["current"] = current
+            now = time.monotonic()
+            interval = self.PLAIN_INTERVAL if self.mode == "plain" else self.min_interval
+            if self.mode != "off" and now - ph["drawn"] >= interval:
+                ph["drawn"] = now
+                self._draw(ph, now)
+
+    def finish(self):
+        """Draw the final state of the current phase and end its line."""
+        with self._lock:
+            ph, self._phase = self._phase, None
+            if ph is None or self.mode == "off":
+                return
+            ph["current"] = max(ph["current"], ph["total"])
+            self._draw(ph, time.monotonic(), final=True)
+
+    def stop(self):
+        """Abandon the current phase (e.g. on error) without a final redraw."""
+        with self._lock:
+            ph, self._phase = self._phase, None
+            if ph is not None and self.mode == "bar" and ph["width"]:
+                self.stream.write("\n")
+                self.stream.flush()
+
+    def _fraction(self, ph):
+        return min(1.0, ph["current"] / ph["total"]) if ph["total"] else 1.0
+
+    def _describe(self, ph, now):
+        elapsed = now - ph["start"]
+        done = ph["current"] - ph["initial"]
+        parts = []
+        if ph["unit"] == "bytes":
+            parts.append(f"{ph['current'] / 1e6:.1f}/{ph['total'] / 1e6:.1f} MB")
+            if elapsed > 0:
+                parts.append(f"{done / 1024 / elapsed:.1f} KB/s")
+        else:
+            parts.append(f"{ph['current']}/{ph['total']} files")
+        if 0 < done and ph["current"] < ph["total"] and elapsed > 0:
+            parts.append(f"ETA {int((ph['total'] - ph['current']) * elapsed / done)}s")
+        if ph["name"] in self.phases and len(self.phases) > 1:
+            idx = self.phases.index(ph["name"])
+            overall = (idx + self._fraction(ph)) / len(self.phases)
+            run_elapsed = now - self.run_start
+            text = f"[{idx + 1}/{len(self.phases)}] overall {overall * 100:.0f}%"
+            if 0 < overall < 1:
+                text += f" ETA {int(run_elapsed * (1 - overall) / overall)}s"
+            parts.append(text)
+        return " | ".join(parts)
+
+    def _draw(self, ph, now, final=False):
+        percent = self._fraction(ph)
+        info = self._describe(ph, now)
+        if self.mode == "plain":
+            self.stream.write(f"{ph['name']}: {percent * 100:5.1f}% | {info}\n")
+        else:
+            filled = int(40 * percent)
+            bar = "█" * filled + "░" * (40 - filled)
+            line = f"{ph['name']:12} |{bar}| {percent * 100:6.2f}% | {info}"
+            # Pad over the remains of a longer previous line.
+            self.stream.write("\r" + line.ljust(ph["width"]) + ("\n" if final else ""))
+            ph["width"] = len(line)
+        self.stream.flush()
+
+PROGRESS = ProgressRenderer()
+
+def load_json(path, default=None):
+    """Load a JSON state file, returning `default` if missing or unreadable."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+def save_json(path, data):
+    """Write a JSON state file atomically (write temp file, then rename)."""
+    path = Path(path)
+    ensure_dir(path.parent)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+def state_dir(target_dir):
+    """Return the per-mirror state directory inside TARGET_DIR."""
+    return Path(target_dir) / STATE_DIRNAME
 
 def safe_log_write(log_fp, text):
     """Safely write logs to file or stdout if log writing fails."""
@@ -143,9 +727,939 @@ def safe_log_write(log_fp, text):
         print("LOG-ERROR: failed to write log, printing instead:", flush=True)
         print(text, flush=True)
 
+# ------------------ File-state cache ------------------
+class FileStateCache:
+    """Persistent digests of target files, keyed by relative path and algorithm.
+
+    Stored in TARGET_DIR/.mirror_state/state.db. A digest is reused as long
+    as the file's size, mtime_ns and inode are unchanged, so files that did
+    not change locally are not read again on every run.
+    """
+
+    def __init__(self, db_path=":memory:", readonly=False):
+        self.readonly = readonly
+        self.hits = self.misses = 0
+        self._pending = 0
+        # Shared by the sync worker threads; all access goes through the lock.
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " path TEXT NOT NULL, algo TEXT NOT NULL,"
+            " size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, ino INTEGER NOT NULL,"
+            " digest TEXT NOT NULL, PRIMARY KEY (path, algo))")
+        # For move detection: find files by content instead of by path
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_size ON files (size, algo, digest)")
+
+    @classmethod
+    def open(cls, target_dir, readonly=False):
+        """Open the cache of a mirror; dry runs never create or modify it."""
+        db_path = state_dir(target_dir) / STATE_DB_FILE
+        if readonly and not db_path.exists():
+            return cls(readonly=True)
+        ensure_dir(db_path.parent)
+        return cls(db_path, readonly)
+
+    def lookup(self, rel, algo, st):
+        """Cached digest of `rel` if its stat info is unchanged, else None."""
+        with self._lock:
+            row = self.db.execute(
+                "SELECT size, mtime_ns, ino, digest FROM files WHERE path = ? AND algo = ?",
+                (Path(rel).as_posix(), algo)).fetchone()
+        if row and row[:3] == (st.st_size, st.st_mtime_ns, st.st_ino):
+            return row[3]
+        return None
+
+    def store(self, rel, algo, st, digest):
+        """Remember the digest of `rel` for the given stat result."""
+        if self.readonly or digest is None:
+            return
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                (Path(rel).as_posix(), algo, st.st_size, st.st_mtime_ns, st.st_ino, digest))
+            self._pending += 1
+            if self._pending >= 500:
+                self.db.commit()
+                self._pending = 0
+
+    def digest(self, path, rel, algo):
+        """Digest of the file at `path`, from the cache or freshly computed."""
+        st = os.stat(path)
+        digest = self.lookup(rel, algo, st)
+        with self._lock:
+            if digest is not None:
+                self.hits += 1
+                return digest
+            self.misses += 1
+        digest = hash_file(path, algo)
+        self.store(rel, algo, st, digest)
+        return digest
+
+    def find(self, size, algo=None, digest=None, limit=4):
+        """Paths of cached files with this size (and digest, if given)."""
+        query, args = "SELECT DISTINCT path FROM files WHERE size = ?", [size]
+        if digest is not None:
+            query += " AND algo = ? AND digest = ?"
+            args += [algo, digest]
+        with self._lock:
+            rows = self.db.execute(query + " LIMIT ?", args + [limit]).fetchall()
+        return [row[0] for row in rows]
+
+    def forget(self, rel):
+        if not self.readonly:
+            with self._lock:
+                self.db.execute("DELETE FROM files WHERE path = ?", (Path(rel).as_posix(),))
+
+    def commit(self):
+        with self._lock:
+            if not self.readonly:
+                self.db.commit()
+            self._pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+def file_digest(cache, path, rel, algo):
+    """Digest via `cache` if one is in use, else computed directly."""
+    if cache is not None:
+        return cache.digest(path, rel, algo)
+    return hash_file(path, algo)
+
+def scan_files(root, skip_dirs=()):
+    """Yield `(rel, path)` string pairs for every file below `root`.
+
+    Walks with os.scandir and a stack of pending directories, so neither a
+    file list nor a Path object per file is ever built. `rel` uses "/" as
+    separator. Top-level directories named in `skip_dirs` are left out;
+    symlinked directories are listed but not followed (like os.walk).
+    """
+    root = os.fspath(root)
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        with os.scandir(os.path.join(root, rel_dir) if rel_dir else root) as it:
+            for entry in it:
+                rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                if not entry.is_dir():
+                    yield rel, entry.path
+                elif not entry.is_symlink() and (rel_dir or entry.name not in skip_dirs):
+                    stack.append(rel)
+
+def iter_target_files(target_dir):
+    """Yield (rel, path) of all mirrored files, skipping mirror internals."""
+    for rel, path in scan_files(target_dir, MIRROR_INTERNAL):
+        if not rel.endswith(".dbxpart"):
+            yield rel, Path(path)
+
+def cache_rebuild(target_dir, algo="sha256"):
+    """Re-hash every mirrored file and replace the cache contents.
+
+    Stores the CRC32 used by the zip/stream modes and the configured
+    DIGEST_ALGO, both computed in a single read of each file.
+    """
+    cache = FileStateCache.open(target_dir)
+    cache.db.execute("DELETE FROM files")
+    algos = list(dict.fromkeys(("crc32", algo)))
+    count = 0
+    for rel, path in iter_target_files(target_dir):
+        st = path.stat()
+        hashers = [new_hasher(a) for a in algos]
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024*1024), b""):
+                for h in hashers:
+                    h.update(chunk)
+        for a, h in zip(algos, hashers):
+            cache.store(rel, a, st, h.hexdigest())
+        count += 1
+    cache.close()
+    print(f"✅ Cache rebuilt: {count} files hashed ({', '.join(algos)})", flush=True)
+    return 0
+
+def cache_validate(target_dir):
+    """Check every cache entry against the file on disk; drop bad entries."""
+    cache = FileStateCache.open(target_dir)
+    rows = cache.db.execute("SELECT path, algo, size, mtime_ns, ino, digest FROM files").fetchall()
+    valid = missing = stale = corrupt = 0
+    for rel, algo, size, mtime_ns, ino, digest in rows:
+        path = Path(target_dir) / rel
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            missing += 1
+        else:
+            if (st.st_size, st.st_mtime_ns, st.st_ino) != (size, mtime_ns, ino):
+                stale += 1
+            elif algo not in DIGEST_BACKENDS or hash_file(path, algo) != digest:
+                corrupt += 1
+                print(f"[!] Digest mismatch: {rel} ({algo})", flush=True)
+            else:
+                valid += 1
+                continue
+        cache.db.execute("DELETE FROM files WHERE path = ? AND algo = ?", (rel, algo))
+    cache.close()
+    print(f"✅ Cache validated: {valid} valid, {missing} missing, {stale} stale, "
+          f"{corrupt} mismatched (invalid entries removed)", flush=True)
+    return 1 if corrupt else 0
+
+# ------------------ Version store ------------------
+LEGACY_VERSION_RE = re.compile(r"(.+)\.(\d{8}-\d{6}(?:-\d+)?)(\.gz|\.xz|\.zst)?")
+
+class VersionStore:
+    """Index of archived versions in .old_versions, in one of two layouts.
+
+    - "files": timestamped copies next to each other (name.txt.<ts>).
+    - "objects": content-addressed; an archived file is moved to
+      objects/<sha256[:2]>/<sha256>, or simply dropped if that object
+      already exists, so identical versions are stored once.
+
+    .old_versions/index.db records (path, ts, digest, size, mtime) per
+    version (digest is "" for timestamped copies), which is what restore
+    and the retention pass work from instead of walking the tree.
+    Unopened (dry runs, KEEP_VERSIONS=no) archive_version still writes
+    timestamped copies.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.db = None
+        self.cache = None
+        self.versions_dir = None
+        self.layout = "files"
+
+    @property
+    def enabled(self):
+        return self.db is not None
+
+    def open(self, versions_dir, cache=None, layout="files"):
+        self.versions_dir = Path(versions_dir)
+        self.cache = cache
+        self.layout = layout
+        ensure_dir(self.versions_dir)
+        self.db = sqlite3.connect(str(self.versions_dir / VERSIONS_INDEX_FILE), check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS versions ("
+            " path TEXT NOT NULL, ts TEXT NOT NULL, digest TEXT NOT NULL,"
+            " size INTEGER NOT NULL, mtime REAL NOT NULL,"
+            " codec TEXT NOT NULL DEFAULT '', stored INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS versions_path ON versions (path, ts)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS versions_digest ON versions (digest)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        return self
+
+    def close(self):
+        if self.db is not None:
+            with self._lock:
+                self.db.commit()
+                self.db.close()
+            self.db = None
+
+    def object_path(self, digest):
+        return self.versions_dir / "objects" / digest[:2] / digest
+
+    def location(self, path, ts, digest, codec=""):
+        """Where the bytes of one indexed version live."""
+        suffix = VERSION_CODECS.get(codec, "")
+        if digest:
+            return self.object_path(digest).with_name(digest + suffix)
+        return self.versions_dir / f"{path}.{ts}{suffix}"
+
+    def archive(self, dest_file, rel, ts):
+        """Move `dest_file` into the store and index it; return its new path."""
+        rel = Path(rel).as_posix()
+        st = os.stat(dest_file)
+        if self.layout == "files":
+            archive_path, ts = archive_copy(dest_file, rel, self.versions_dir, ts)
+            with self._lock:
+                self.db.execute("INSERT INTO versions (path, ts, digest, size, mtime)"
+                                " VALUES (?, ?, '', ?, ?)", (rel, ts, st.st_size, st.st_mtime))
+                self.db.commit()
+            return archive_path
+
+        digest = None
+        if self.cache is not None:
+            digest = self.cache.lookup(rel, OBJECT_DIGEST, st)
+        digest = digest or hash_file(dest_file, OBJECT_DIGEST)
+        if digest is None:
+            raise IOError(f"Cannot read {rel} to archive it")
+        ensure_dir(self.object_path(digest).parent)
+        # Under the lock, so the pruner cannot drop the object in between.
+        with self._lock:
+            known = self.db.execute("SELECT codec, stored FROM versions WHERE digest = ? LIMIT 1",
+                                    (digest,)).fetchone()
+            codec, stored = known or ("", None)
+            obj = self.location(rel, ts, digest, codec)
+            if obj.exists():
+                os.unlink(dest_file)  # Same bytes are already stored.
+            else:
+                codec, stored = "", None
+                obj = self.object_path(digest)
+                os.replace(dest_file, obj)
+            self.db.execute("INSERT INTO versions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (rel, ts, digest, st.st_size, st.st_mtime, codec, stored))
+            self.db.commit()
+        return obj
+
+    def versions(self, rel):
+        """Archived versions of `rel` as (ts, digest, size, mtime, codec), oldest first."""
+        with self._lock:
+            return self.db.execute(
+                "SELECT ts, digest, size, mtime, codec FROM versions WHERE path = ? ORDER BY ts, rowid",
+                (Path(rel).as_posix(),)).fetchall()
+
+    def import_legacy(self, deadline=None):
+        """Index timestamped copies archived before the index existed.
+
+        Stops at `deadline` (time.monotonic()) with what it found so far
+        indexed; the next call skips those. Returns True once all are in.
+        """
+        with self._lock:
+            if self.db.execute("SELECT 1 FROM meta WHERE key = 'legacy_imported'").fetchone():
+                return True
+            known = {(p, t) for p, t in self.db.execute("SELECT path, ts FROM versions WHERE digest = ''")}
+        rows = []
+        finished = True
+        for name, path in scan_files(self.versions_dir, ("objects",)):
+            if deadline is not None and time.monotonic() > deadline:
+                finished = False
+                break
+            m = LEGACY_VERSION_RE.fullmatch(name)
+            if m and (m.group(1), m.group(2)) not in known:
+                st = os.stat(path)
+                codec = next((c for c, ext in VERSION_CODECS.items() if ext == m.group(3)), "")
+                rows.append((m.group(1), m.group(2), st.st_size, st.st_mtime, codec,
+                             st.st_size if codec else None))
+        with self._lock:
+            self.db.executemany("INSERT INTO versions VALUES (?, ?, '', ?, ?, ?, ?)", rows)
+            if finished:
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('legacy_imported', ?)", (timestamp(),))
+            self.db.commit()
+        return finished
+
+VERSIONS = VersionStore()
+
+def archive_copy(dest_file, rel, versions_dir, ts):
+    """Move `dest_file` to a timestamped copy; return (path, ts suffix used)."""
+    archive_path = versions_dir / f"{rel}.{ts}"
+    n = 1
+    while archive_path.exists():  # Archived twice within a second
+        archive_path = versions_dir / f"{rel}.{ts}-{n}"
+        n += 1
+    ensure_dir(archive_path.parent)
+    shutil.move(str(dest_file), str(archive_path))
+    return archive_path, archive_path.name[len(Path(rel).name) + 1:]
+
+def list_versions(target_dir, rel):
+    """All archived versions of `rel` as (ts, source path, mtime), oldest first.
+
+    Combines the index with timestamped copies found next to the file, so
+    versions archived before the index existed still show.
+    """
+    versions_dir = Path(target_dir) / VERSIONS_DIRNAME
+    found = {}
+    legacy = versions_dir / rel
+    if legacy.parent.is_dir():
+        for entry in os.scandir(legacy.parent):
+            m = LEGACY_VERSION_RE.fullmatch(entry.name)
+            if m and m.group(1) == legacy.name and entry.is_file():
+                found[entry.path] = (m.group(2), Path(entry.path), entry.stat().st_mtime)
+    if (versions_dir / VERSIONS_INDEX_FILE).exists():
+        store = VersionStore().open(versions_dir)
+        try:
+            for ts, digest, _, mtime, codec in store.versions(rel):
+                path = store.location(rel, ts, digest, codec)
+                found[(ts, digest) if digest else os.fspath(path)] = (ts, path, mtime)
+        finally:
+            store.close()
+    return sorted(found.values(), key=lambda v: v[0])
+
+def parse_size(value):
+    """Bytes for a size like "500M", "2G" or "1048576" (0 if empty)."""
+    value = str(value).strip().upper().rstrip("B")
+    if not value:
+        return 0
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    if value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def prune_versions(store, keep_count=0, max_age_days=0, max_bytes=0, budget=None, dry_run=False):
+    """Apply the retention settings to the versions in `store`'s index.
+
+    Victims are, in this order: versions beyond the newest `keep_count` of
+    a path, versions older than `max_age_days`, then the oldest versions
+    overall until the store holds at most `max_bytes` (0 disables a rule).
+    Everything is decided from the index, and with a `budget` (seconds)
+    the pass stops when time is up; the rest is picked up next run. Old
+    copies not indexed yet are imported first, within the same budget.
+    Returns (versions removed, bytes reclaimed, finished).
+    """
+    deadline = time.monotonic() + budget if budget else None
+    if not dry_run and not store.import_legacy(deadline):
+        return 0, 0, False
+    with store._lock:
+        refs = dict(store.db.execute(
+            "SELECT digest, COUNT(*) FROM versions WHERE digest != '' GROUP BY digest"))
+        total = store.db.execute(
+            "SELECT COALESCE(SUM(COALESCE(stored, size)), 0) FROM versions WHERE digest = ''").fetchone()[0]
+        total += store.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM (SELECT MAX(COALESCE(stored, size)) AS size FROM versions"
+            " WHERE digest != '' GROUP BY digest)").fetchone()[0]
+        expired = []
+        if keep_count:
+            expired += store.db.execute(
+                "SELECT rowid, path, ts, digest, COALESCE(stored, size), codec FROM (SELECT rowid, *,"
+                " ROW_NUMBER() OVER (PARTITION BY path ORDER BY ts DESC, rowid DESC) AS n FROM versions)"
+                " WHERE n > ? ORDER BY ts", (keep_count,)).fetchall()
+        if max_age_days:
+            cutoff = datetime.fromtimestamp(time.time() - max_age_days * 86400).strftime("%Y%m%d-%H%M%S")
+            expired += store.db.execute(
+                "SELECT rowid, path, ts, digest, COALESCE(stored, size), codec FROM versions"
+                " WHERE ts < ? ORDER BY ts",
+                (cutoff,)).fetchall()
+        oldest = store.db.execute(
+            "SELECT rowid, path, ts, digest, COALESCE(stored, size), codec FROM versions"
+            " ORDER BY ts, rowid").fetchall() if max_bytes else []
+
+    removed = reclaimed = 0
+    done = set()
+    for i, (rowid, path, ts, digest, size, codec) in enumerate(expired + oldest):
+        if rowid in done:
+            continue
+        if i >= len(expired) and total - reclaimed <= max_bytes:
+            break
+        if deadline is not None and time.monotonic() > deadline:
+            return removed, reclaimed, False
+        freed = size
+        if digest:
+            refs[digest] -= 1
+            if refs[digest] > 0:
+                freed = 0  # Another version still points at the object.
+        if not dry_run:
+            with store._lock:
+                store.db.execute("DELETE FROM versions WHERE rowid = ?", (rowid,))
+                # Re-check under the lock: an archive may have reused the object.
+                if not digest or not store.db.execute(
+                        "SELECT 1 FROM versions WHERE digest = ? LIMIT 1", (digest,)).fetchone():
+                    try:
+                        os.unlink(store.location(path, ts, digest, codec))
+                    except FileNotFoundError:
+                        pass
+                    if not digest:
+                        remove_empty_parents(store.versions_dir, path, set())
+                store.db.commit()
+        done.add(rowid)
+        removed += 1
+        reclaimed += freed
+    return removed, reclaimed, True
+
+class BackgroundPrune(threading.Thread):
+    """Runs prune_versions alongside the sync, within a time budget."""
+
+    def __init__(self, store, retention, budget, dry_run=False):
+        super().__init__(name="prune-versions", daemon=True)
+        self.store = store
+        self.retention = retention
+        self.budget = budget
+        self.dry_run = dry_run
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = prune_versions(self.store, *self.retention,
+                                         budget=self.budget, dry_run=self.dry_run)
+        except Exception as e:  # Pruning must never fail the sync
+            self.error = e
+
+    def report(self, log_fp=None):
+        """Wait for the pass and print what it reclaimed."""
+        self.join()
+        if self.error is not None:
+            print(f"Warning: pruning old versions failed: {self.error}", flush=True)
+            return
+        removed, reclaimed, finished = self.result
+        if removed or not finished:
+            verb = "Would prune" if self.dry_run else "Pruned"
+            more = "" if finished else " (more next run)"
+            print(f"🧹 {verb} {removed} old versions ({reclaimed / 1e6:.1f} MB reclaimed){more}", flush=True)
+        if log_fp is not None:
+            safe_log_write(log_fp, f"{timestamp()} PRUNE: removed={removed} bytes={reclaimed} "
+                                   f"finished={finished} dry_run={self.dry_run}\n")
+
+def prune_command(target_dir, retention, dry_run=False):
+    """Apply the retention settings to .old_versions without a time budget."""
+    versions_dir = Path(expand_path(target_dir)) / VERSIONS_DIRNAME
+    if not any(retention):
+        print("[!] Set VERSIONS_KEEP_COUNT, VERSIONS_MAX_AGE_DAYS or VERSIONS_MAX_BYTES first", flush=True)
+        return 1
+    if not versions_dir.is_dir():
+        print("🧹 No archived versions to prune", flush=True)
+        return 0
+    if dry_run and not (versions_dir / VERSIONS_INDEX_FILE).exists():
+        print("[!] No version index yet; run once without --dry-run to build it", flush=True)
+        return 1
+    store = VersionStore().open(versions_dir)
+    try:
+        pruner = BackgroundPrune(store, retention, None, dry_run)
+        pruner.start()
+        pruner.report()
+    finally:
+        store.close()
+    return 0 if pruner.error is None else 2
+
+def restore_version(target_dir, rel, at=None, output=None, list_only=False, layout="files"):
+    """List or materialize an archived version of `rel` (newest by default).
+
+    Restores into TARGET_DIR/rel unless `output` is given; the copy being
+    replaced is archived first, so a restore can itself be undone.
+    """
+    target_dir = Path(expand_path(target_dir))
+    rel = Path(rel).as_posix().lstrip("/")
+    versions = list_versions(target_dir, rel)
+    if not versions:
+        print(f"[!] No archived versions of {rel}", flush=True)
+        return 1
+    if list_only:
+        print(f"🕘 Versions of {rel}:", flush=True)
+        for ts, src, _ in versions:
+            size = src.stat().st_size if src.exists() else None
+            print(f"   {ts}  {size if size is not None else 'missing':>12}  {src.name}", flush=True)
+        return 0
+    matches = [v for v in versions if at is None or v[0].startswith(at)]
+    if not matches:
+        print(f"[!] No version of {rel} matches {at!r}", flush=True)
+        return 1
+    ts, src, mtime = matches[-1]
+    dest = Path(expand_path(output)) if output else target_dir / rel
+    ensure_dir(dest.parent)
+    codec = version_codec(src)
+    if codec:
+        with open_codec(src, codec) as f:
+            staging = stage_file(iter(lambda: f.read(COPIER.buffer_size), b""), dest)
+    else:
+        staging = staging_path(dest)
+        COPIER.copy(src, staging)
+    os.utime(staging, (mtime, mtime))
+    if dest.exists() and not output:
+        versions_dir = target_dir / VERSIONS_DIRNAME
+        VERSIONS.open(versions_dir, layout=layout)
+        try:
+            archive_version(dest, rel, versions_dir)
+        finally:
+            VERSIONS.close()
+    os.replace(staging, dest)
+    print(f"♻️  Restored {rel} from {ts} to {dest}", flush=True)
+    return 0
+
+# ------------------ Version compression ------------------
+# VERSIONS_COMPRESS codec -> suffix of compressed versions. In the index,
+# codec "" marks a version not looked at yet and "raw" one kept as it is.
+VERSION_CODECS = {"gzip": ".gz", "lzma": ".xz", "zstd": ".zst"}
+COMPRESS_MODES = ("none",) + tuple(VERSION_CODECS)
+# Codecs that need an extra module: name -> pip package (or None: stdlib)
+OPTIONAL_CODECS = {"lzma": (lzma, None), "zstd": (zstandard, "zstandard")}
+# Media and archives are compressed already; recompressing only burns CPU.
+PRECOMPRESSED_EXTENSIONS = frozenset((
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".heif", ".avif",
+    ".mp4", ".m4v", ".mov", ".mkv", ".webm", ".avi", ".3gp",
+    ".mp3", ".m4a", ".aac", ".ogg", ".opus", ".flac",
+    ".zip", ".gz", ".tgz", ".xz", ".zst", ".bz2", ".7z", ".rar", ".apk",
+    ".docx", ".xlsx", ".pptx", ".odt", ".ods", ".epub",
+))
+PRECOMPRESSED_MAGIC = (
+    b"\xff\xd8\xff", b"\x89PNG", b"GIF8", b"PK\x03\x04", b"\x1f\x8b", b"\xfd7zXZ",
+    b"\x28\xb5\x2f\xfd", b"BZh", b"7z\xbc\xaf", b"Rar!", b"OggS", b"fLaC", b"ID3",
+    b"\x1a\x45\xdf\xa3",  # Matroska / WebM
+)
+COMPRESS_MIN_SAVING = 0.1  # Keep versions raw unless compression saves 10%
+
+def is_precompressed(name, head):
+    """True if a file is a compressed format, judged by extension and magic bytes."""
+    if Path(name).suffix.lower() in PRECOMPRESSED_EXTENSIONS:
+        return True
+    return (head.startswith(PRECOMPRESSED_MAGIC)
+            or head[4:8] == b"ftyp"  # MP4 / MOV / HEIC
+            or (head[:4] == b"RIFF" and head[8:12] in (b"WEBP", b"AVI ")))
+
+def version_codec(path):
+    """Codec of an archived version, from its suffix ("" if stored raw)."""
+    suffix = Path(path).suffix
+    return next((codec for codec, ext in VERSION_CODECS.items() if ext == suffix), "")
+
+def open_codec(path, codec, mode="rb"):
+    """Open `path` for reading or writing through `codec`."""
+    if codec == "gzip":
+        return gzip.open(path, mode, compresslevel=6)
+    if codec == "lzma":
+        return lzma.open(path, mode, preset=6) if "w" in mode else lzma.open(path, mode)
+    if codec == "zstd":
+        f = open(path, mode)
+        if "w" in mode:
+            return zstandard.ZstdCompressor(level=9).stream_writer(f)
+        return zstandard.ZstdDecompressor().stream_reader(f)
+    raise ValueError(f"Unknown codec {codec!r}")
+
+def compress_version(src, name, codec, stop_at=None):
+    """Compress `src` into a temp file next to it (runs in a worker).
+
+    `name` is the file's name in the mirror, for the extension check.
+    Returns (temp path, compressed size), or None if it is not worth it.
+    Raises BudgetExhausted, leaving no temp file, once the wall-clock time
+    `stop_at` has passed.
+    """
+    with open(src, "rb") as f:
+        head = f.read(16)
+    if is_precompressed(name, head):
+        return None
+    tmp = f"{src}{VERSION_CODECS[codec]}.tmp"
+    try:
+        with open(src, "rb") as inp, open_codec(tmp, codec, "wb") as out:
+            for chunk in iter(lambda: inp.read(1 << 20), b""):
+                if stop_at is not None and time.time() >= stop_at:
+                    raise BudgetExhausted("compression time budget used up")
+                out.write(chunk)
+        stored = os.path.getsize(tmp)
+        if stored > os.path.getsize(src) * (1 - COMPRESS_MIN_SAVING):
+            os.unlink(tmp)
+            return None
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return tmp, stored
+
+def _lower_priority():
+    """Worker initializer: leave the CPU to the foreground apps."""
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+
+def compress_pool(workers):
+    """A low-priority process pool, or threads where processes are unavailable.
+
+    Android's Python may lack a working sem_open, which multiprocessing
+    needs; zlib and lzma release the GIL, so threads still overlap.
+    """
+    try:
+        return ProcessPoolExecutor(max_workers=workers, initializer=_lower_priority)
+    except (ImportError, OSError, NotImplementedError):
+        return ThreadPoolExecutor(max_workers=workers)
+
+def compress_versions(store, codec, workers=1, budget=None):
+    """Compress archived versions not looked at yet, oldest first.
+
+    Files are compressed by `workers` low-priority processes; once `budget`
+    seconds have passed, no new file is started and the running ones are
+    given up, the rest waits for the next run. Identical objects are
+    compressed once. Returns (versions compressed, bytes saved, finished).
+    """
+    deadline = time.monotonic() + budget if budget else None
+    stop_at = time.time() + budget if budget else None  # Workers' clock
+    with store._lock:
+        rows = store.db.execute(
+            "SELECT rowid, path, ts, digest, size FROM versions WHERE codec = ''"
+            " ORDER BY ts, rowid").fetchall()
+    jobs = []
+    digests = set()
+    for row in rows:
+        if row[3] in digests:
+            continue
+        if row[3]:
+            digests.add(row[3])
+        jobs.append(row)
+
+    compressed = saved = 0
+    pending = iter(jobs)
+    running = {}
+    started = stopped = 0
+    with compress_pool(workers) as pool:
+        while True:
+            while len(running) < workers and (deadline is None or time.monotonic() < deadline):
+                job = next(pending, None)
+                if job is None:
+                    break
+                src = store.location(job[1], job[2], job[3])
+                running[pool.submit(compress_version, str(src), posixpath.basename(job[1]),
+                                    codec, stop_at)] = job
+                started += 1
+            if not running:
+                break
+            # Past the deadline the workers give up within one chunk.
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                rowid, path, ts, digest, size = running.pop(future)
+                match = ("digest = ?", digest) if digest else ("rowid = ?", rowid)
+                try:
+                    result = future.result()
+                except BudgetExhausted:
+                    stopped += 1  # Stays codec = '' for the next run
+                    continue
+                except OSError as e:
+                    print(f"Warning: could not compress {path}.{ts}: {e}", flush=True)
+                    continue
+                with store._lock:
+                    if result is None:
+                        store.db.execute(f"UPDATE versions SET codec = 'raw' WHERE {match[0]}", match[1:])
+                    else:
+                        tmp, stored = result
+                        src = store.location(path, ts, digest)
+                        os.replace(tmp, store.location(path, ts, digest, codec))
+                        os.unlink(src)
+                        store.db.execute(f"UPDATE versions SET codec = ?, stored = ? WHERE {match[0]}",
+                                         (codec, stored) + match[1:])
+                        compressed += 1
+                        saved += size - stored
+                    store.db.commit()
+    return compressed, saved, started == len(jobs) and not stopped
+
+def compress_old_versions(codec, workers, budget, log_fp=None):
+    """Run compress_versions on VERSIONS after a sync and print the outcome."""
+    if BUDGET.enabled:
+        if BUDGET.expired():
+            return
+        budget = min(budget or BUDGET.remaining(), BUDGET.remaining())
+    try:
+        compressed, saved, finished = compress_versions(VERSIONS, codec, workers, budget)
+    except Exception as e:  # Compression must never fail the sync
+        print(f"Warning: compressing old versions failed: {e}", flush=True)
+        return
+    if compressed or not finished:
+        more = "" if finished else " (more next run)"
+        print(f"🗜️  Compressed {compressed} old versions ({saved / 1e6:.1f} MB saved){more}", flush=True)
+    if log_fp is not None:
+        safe_log_write(log_fp, f"{timestamp()} COMPRESS: codec={codec} versions={compressed} "
+                               f"saved={saved} finished={finished}\n")
+
+# ------------------ Remote validators ------------------
+def response_validators(url, headers):
+    """Extract the cache validators of a download response."""
+    return {
+        "url": url,
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+        "content_length": headers.get("Content-Length"),
+    }
+
+def conditional_headers(url, validators):
+    """Build If-None-Match / If-Modified-Since headers from saved validators."""
+    if not validators or validators.get("url") != url:
+        return {}
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+def validators_match(saved, current):
+    """True if the current response provably describes the saved archive.
+
+    Some servers ignore conditional headers and answer 200 anyway; comparing
+    the validators ourselves lets us drop the body before reading it.
+    """
+    if not saved or saved.get("url") != current.get("url"):
+        return False
+    if saved.get("etag") and current.get("etag"):
+        return saved["etag"] == current["etag"]
+    if saved.get("last_modified") and current.get("last_modified"):
+        return (saved["last_modified"] == current["last_modified"]
+                and saved.get("content_length") == current.get("content_length"))
+    return False
+
 # ------------------ Core Functions ------------------
-def download_zip(url, out_path):
-    """Download ZIP with visual progress bar and ETA."""
+def range_validator(validators):
+    """Pick the validator usable in If-Range (a strong ETag or Last-Modified)."""
+    etag = validators.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return validators.get("last_modified")
+
+def response_total_size(r):
+    """Full size of the remote file, also for 206 Partial Content replies."""
+    content_range = r.headers.get("Content-Range", "")
+    if "/" in content_range and not content_range.endswith("/*"):
+        return int(content_range.rsplit("/", 1)[1])
+    return int(r.headers.get("content-length", 0))
+
+def partial_paths(out_path):
+    """Return (.part file, .part.json sidecar) used to resume a download."""
+    out_path = Path(out_path)
+    return (out_path.with_name(out_path.name + ".part"),
+            out_path.with_name(out_path.name + ".part.json"))
+
+def resume_offset(url, part_path, sidecar_path):
+    """Return (offset, validator) to resume from, or (0, None) to start over.
+
+    The sidecar records how many bytes were flushed to the .part file and
+    the validator of the response they belong to; anything past the
+    recorded offset may be torn and is truncated away.
+    """
+    meta = load_json(sidecar_path)
+    if not meta or meta.get("url") != url or not meta.get("validator"):
+        return 0, None
+    try:
+        offset = min(int(meta.get("offset", 0)), part_path.stat().st_size)
+    except (OSError, ValueError):
+        return 0, None
+    if offset <= 0:
+        return 0, None
+    with open(part_path, "r+b") as f:
+        f.truncate(offset)
+    return offset, meta["validator"]
+
+def split_ranges(start, end, parts, min_size=1024 * 1024):
+    """Split [start, end) into up to `parts` contiguous [start, end) ranges."""
+    length = end - start
+    parts = max(1, min(parts, length // min_size or 1))
+    step = -(-length // parts)
+    return [[a, min(a + step, end)] for a in range(start, end, step)]
+
+def download_ranged(url, part_path, sidecar_path, validators, connections):
+    """Fetch `url` into `part_path` over several concurrent Range requests.
+
+    Returns `(status, current_validators)` with status one of
+    "not-modified", "complete" or "unsupported" (server cannot do ranges;
+    the caller should fall back to a single stream).
+
+    The part file is preallocated and each connection writes its byte range
+    with positional writes. Per-range progress is checkpointed into the
+    sidecar, so an interrupted transfer resumes only the missing pieces.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    probe_headers = conditional_headers(url, validators)
+    probe_headers["Range"] = "bytes=0-0"
+    with session.get(url, stream=True, timeout=60, headers=probe_headers) as probe:
+        if probe.status_code == 304:
+            session.close()
+            return "not-modified", validators
+        probe.raise_for_status()
+        current = response_validators(url, probe.headers)
+        total_size = response_total_size(probe)
+        current["content_length"] = str(total_size) if total_size else None
+        validator = range_validator(current)
+        # Ranges also avoid the redirect hop Dropbox does for every request.
+        range_url = probe.url
+        supported = probe.status_code == 206 and total_size > 0 and validator
+    if validators_match(validators, current):
+        session.close()
+        return "not-modified", validators
+    if not supported:
+        session.close()
+        return "unsupported", current
+
+    meta = load_json(sidecar_path) or {}
+    if (meta.get("url") == url and meta.get("validator") == validator
+            and meta.get("size") == total_size and meta.get("segments")
+            and part_path.exists() and part_path.stat().st_size == total_size):
+        segments = meta["segments"]
+        print("↪️  Resuming ranged download", flush=True)
+    else:
+        # A single-stream partial of the same file still counts as done.
+        prefix = 0
+        if meta.get("url") == url and meta.get("validator") == validator and part_path.exists():
+            prefix = min(int(meta.get("offset", 0)), part_path.stat().st_size)
+        segments = [[a, a, b] for a, b in split_ranges(prefix, total_size, connections)]
+        if prefix:
+            segments.insert(0, [0, prefix, prefix])
+            print(f"↪️  Resuming download at {prefix/1024/1024:.1f} MB", flush=True)
+    # segment = [start, next byte to fetch, end)
+    meta = {"url": url, "validator": validator, "size": total_size, "segments": segments}
+
+    def contiguous_done():
+        done = 0
+        for seg_start, pos, seg_end in segments:
+            if seg_start != done:
+                break
+            done = pos
+            if pos != seg_end:
+                break
+        return done
+
+    def checkpoint():
+        meta["offset"] = contiguous_done()
+        save_json(sidecar_path, meta)
+
+    lock = threading.Lock()
+    fd = os.open(part_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size != total_size:
+            os.ftruncate(fd, total_size)
+            if hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(fd, 0, total_size)
+                except OSError:
+                    pass  # Sparse file it is.
+        checkpoint()
+
+        def fetch(seg):
+            if seg[1] >= seg[2]:
+                return
+            headers = {"Range": f"bytes={seg[1]}-{seg[2] - 1}", "If-Range": validator}
+            with session.get(range_url, stream=True, timeout=60, headers=headers) as r:
+                r.raise_for_status()
+                if r.status_code != 206 or not r.headers.get("Content-Range", "").startswith(f"bytes {seg[1]}-"):
+                    raise IOError("Remote ZIP changed during download (will restart next run)")
+                for chunk in r.iter_content(chunk_size=64 * 1024):
+                    BUDGET.check()
+                    if chunk:
+                        os.pwrite(fd, chunk, seg[1])
+                        IO_STATS.add(written=len(chunk))
+                        with lock:
+                            seg[1] += len(chunk)
+            if seg[1] != seg[2]:
+                raise IOError(f"Range {seg[0]}-{seg[2]} ended early at {seg[1]}")
+
+        print(f"🔀 Downloading with {len(segments)} connections", flush=True)
+        initial = sum(pos - a for a, pos, _ in segments)
+        PROGRESS.start("Downloading", total_size, unit="bytes", initial=initial)
+        last_checkpoint = time.time()
+        with ThreadPoolExecutor(max_workers=connections) as pool:
+            pending = {pool.submit(fetch, seg) for seg in segments}
+            try:
+                while pending:
+                    finished, pending = wait(pending, timeout=0.5, return_when=FIRST_EXCEPTION)
+                    for fut in finished:
+                        fut.result()
+                    with lock:
+                        downloaded = sum(pos - a for a, pos, _ in segments)
+                    PROGRESS.update(downloaded)
+                    if time.time() - last_checkpoint >= 2:
+                        with lock:
+                            checkpoint()
+                        last_checkpoint = time.time()
+            except BaseException:
+                for fut in pending:
+                    fut.cancel()
+                raise
+        PROGRESS.finish()
+    finally:
+        with lock:
+            checkpoint()
+        os.close(fd)
+        session.close()
+    return "complete", current
+
+def download_zip(url, out_path, validators=None, connections=1):
+    """Download ZIP with visual progress bar and ETA.
+
+    Returns `(path, validators)`. If `validators` from the last successful
+    sync show the remote archive is unchanged, nothing is downloaded and
+    `path` is None.
+
+    Data is streamed into `<out_path>.part`. If the transfer is interrupted,
+    the next call resumes it with a Range request guarded by If-Range, so an
+    archive that changed in the meantime is fetched from scratch instead.
+
+    With `connections` > 1 the archive is fetched by `download_ranged` over
+    several parallel connections when the server supports byte ranges.
+    """
     out_path = Path(expand_path(out_path))
     ensure_dir(out_path.parent)
     safe_url = strip_ansi_and_control(url)
@@ -154,104 +1668,1621 @@ def download_zip(url, out_path):
     if not validate_url(safe_url):
         raise ValueError(f"Invalid URL: {safe_url}")
 
-    with requests.get(safe_url, stream=True, timeout=60) as r:
+    part_path, sidecar_path = partial_paths(out_path)
+    if connections > 1:
+        status, current = download_ranged(safe_url, part_path, sidecar_path, validators, connections)
+        if status == "not-modified":
+            print("✅ Remote ZIP unchanged since last sync.", flush=True)
+            return None, validators
+        if status == "complete":
+            os.replace(part_path, out_path)
+            sidecar_path.unlink(missing_ok=True)
+            print("✅ Download complete.", flush=True)
+            return out_path, current
+        print("ℹ️  Server does not support ranges, using a single connection", flush=True)
+
+    offset, part_validator = resume_offset(safe_url, part_path, sidecar_path)
+
+    headers = conditional_headers(safe_url, validators)
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = part_validator
+    with requests.get(safe_url, stream=True, timeout=60, headers=headers) as r:
+        if r.status_code == 304:
+            print("✅ Remote ZIP not modified since last sync.", flush=True)
+            return None, validators
+        if r.status_code == 416:
+            # Our partial file does not fit the remote one; start over.
+            part_path.unlink(missing_ok=True)
+            sidecar_path.unlink(missing_ok=True)
+            return download_zip(url, out_path, validators)
         r.raise_for_status()
-        total_size = int(r.headers.get("content-length", 0))
-        downloaded = 0
-        start_time = time.time()
-        with open(out_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-                    downloaded += len(chunk)
-                    elapsed = time.time() - start_time
-                    speed = downloaded / elapsed if elapsed > 0 else 0
-                    eta = (total_size - downloaded) / speed if speed > 0 else 0
-                    if total_size > 0:
-                        print_progress_bar(downloaded, total_size, prefix="Downloading", speed=speed, eta=eta)
+        current = response_validators(safe_url, r.headers)
+        total_size = response_total_size(r)
+        current["content_length"] = str(total_size) if total_size else None
+        if validators_match(validators, current):
+            print("✅ Remote ZIP unchanged since last sync.", flush=True)
+            return None, validators
+
+        if r.status_code == 206 and r.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+            print(f"↪️  Resuming download at {offset/1024/1024:.1f} MB", flush=True)
+            mode = "ab"
+        else:
+            offset, mode = 0, "wb"
+        meta = {"url": safe_url, "validator": range_validator(current), "offset": offset}
+        save_json(sidecar_path, meta)
+
+        downloaded = offset
+        checkpoint = offset
+        if total_size > 0:
+            PROGRESS.start("Downloading", total_size, unit="bytes", initial=offset)
+        with open(part_path, mode) as f:
+            try:
+                for chunk in r.iter_content(chunk_size=8192):
+                    BUDGET.check()
+                    if chunk:
+                        f.write(chunk)
+                        IO_STATS.add(written=len(chunk))
+                        downloaded += len(chunk)
+                        if downloaded - checkpoint >= 4 * 1024 * 1024:
+                            f.flush()
+                            meta["offset"] = checkpoint = downloaded
+                            save_json(sidecar_path, meta)
+                        PROGRESS.update(downloaded)
+            finally:
+                # Record everything that reached the file, also on failure,
+                # so that the next run can continue from here.
+                f.flush()
+                meta["offset"] = downloaded
+                save_json(sidecar_path, meta)
+
+    if total_size and downloaded != total_size:
+        PROGRESS.stop()
+        raise IOError(f"Download incomplete: got {downloaded} of {total_size} bytes (will resume next run)")
+    PROGRESS.finish()
+    os.replace(part_path, out_path)
+    sidecar_path.unlink(missing_ok=True)
     print("✅ Download complete.", flush=True)
-    return out_path
+    return out_path, current
+
+def load_resume(target_dir):
+    """Progress of a run stopped by MAX_RUNTIME, if its kept ZIP is still intact."""
+    resume = load_json(state_dir(target_dir) / RESUME_FILE)
+    if not resume:
+        return None
+    zip_path = Path(resume.get("zip", ""))
+    if not zip_path.is_file() or zip_path.stat().st_size != resume.get("zip_size"):
+        return None
+    return resume
+
+def is_safe_member(name):
+    """Reject ZIP member names that would escape the destination."""
+    return ".." not in Path(name).parts and not name.startswith("/")
+
+def archive_version(dest_file, rel, versions_dir):
+    """Move the current copy of a file into .old_versions with a timestamp."""
+    ts = datetime.now().strftime("%Y%m%d-%H%M%S")
+    if VERSIONS.enabled:
+        return VERSIONS.archive(dest_file, rel, ts)
+    return archive_copy(dest_file, rel, versions_dir, ts)[0]
+
+def zip_mtime(zi):
+    """ZipInfo.date_time (local time) as POSIX timestamp, None if invalid."""
+    try:
+        return time.mktime(zi.date_time + (0, 0, -1))
+    except (OverflowError, ValueError):
+        return None
+
+def quick_verdict(size, mtime, dest_st, compare_mode):
+    """Decide from stat info alone: "changed", "same" or None (compare content).
+
+    A size mismatch always means changed, so hashing it would be pointless.
+    In the quick modes, equal size and mtime mean unchanged; "quick" then
+    treats a different mtime as changed, "quick+verify" compares content.
+    """
+    if size is not None and dest_st.st_size != size:
+        return "changed"
+    if compare_mode == "hash" or size is None or mtime is None:
+        return None
+    if abs(dest_st.st_mtime - mtime) <= MTIME_WINDOW:
+        return "same"
+    return "changed" if compare_mode == "quick" else None
+
+def adopt_mtime(dest_file, rel, mtime, cache, algo, digest):
+    """Give an unchanged file the ZIP's mtime so the next quick check hits."""
+    os.utime(dest_file, (mtime, mtime))
+    if cache is not None:
+        cache.store(rel, algo, dest_file.stat(), digest)
+
+def resolve_workers(value):
+    """Number of sync worker threads for a SYNC_WORKERS value ("auto" or N)."""
+    if str(value).lower() in ("", "auto", "0"):
+        return min(8, os.cpu_count() or 1)
+    try:
+        return max(1, int(value))
+    except ValueError:
+        print(f"Warning: invalid SYNC_WORKERS={value!r}, using auto", flush=True)
+        return min(8, os.cpu_count() or 1)
 
-def extract_zip(zip_path, dest_dir):
-    """Extract ZIP safely and show progress (apt-like)."""
+def parallel_map(func, items, workers):
+    """Yield `(item, result, error)` for each item, in input order.
+
+    Runs `func` on up to `workers` threads (hashlib and file I/O release the
+    GIL) with a bounded number of tasks in flight, so results and log lines
+    come out in the same deterministic order as with a single thread.
+    """
+    def call(item):
+        try:
+            return item, func(item), None
+        except Exception as e:
+            return item, None, e
+
+    if workers <= 1:
+        for item in items:
+            yield call(item)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        for item in items:
+            in_flight.append(pool.submit(call, item))
+            if len(in_flight) >= workers * 4:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+def print_summary(summary):
+    """Print the per-run counters."""
+    print("\n📊 Sync Summary:")
+    for k, v in summary.items():
+        print(f"   {k:8}: {v}")
+
+def extract_zip(zip_path, dest_dir, algo=None):
+    """Extract ZIP safely and show progress (apt-like).
+
+    If `algo` is given, each member is hashed while it is written and a
+    {relative path: digest} dict is returned, so the extracted copies never
+    have to be read back just to compare them.
+    """
     dest_dir = Path(expand_path(dest_dir))
     ensure_dir(dest_dir)
     print(f"📦 Extracting ZIP: {zip_path}", flush=True)
 
+    digests = {}
     with zipfile.ZipFile(str(zip_path), "r") as z:
         safe_members = []
         for zi in z.infolist():
-            if ".." in Path(zi.filename).parts or zi.filename.startswith("/"):
+            if not is_safe_member(zi.filename):
                 print(f"[!] Skipping suspicious file: {zi.filename}", flush=True)
                 continue
             safe_members.append(zi)
         total_files = len(safe_members)
+        KNOWN_DIRS.prepare(dest_dir, (zi.filename for zi in safe_members))
+        PROGRESS.start("Extracting", total_files)
         for idx, member in enumerate(safe_members, 1):
-            z.extract(member, path=str(dest_dir))
-            print_progress_bar(idx, total_files, prefix="Extracting")
+            extracted = dest_dir / member.filename
+            if member.is_dir():
+                ensure_dir(extracted)
+            else:
+                ensure_dir(extracted.parent)
+                h = new_hasher(algo) if algo else None
+                with open(extracted, "wb") as out:
+                    for chunk in iter_member_chunks(z, member):
+                        out.write(chunk)
+                        IO_STATS.add(written=len(chunk))
+                        if h:
+                            h.update(chunk)
+                if h:
+                    digests[Path(member.filename).as_posix()] = h.hexdigest()
+                mtime = zip_mtime(member)
+                if mtime is not None:
+                    # Keep the ZIP timestamp; copy2 carries it over to the target.
+                    os.utime(extracted, (mtime, mtime))
+            PROGRESS.update(idx)
+        PROGRESS.finish()
     print(f"✅ Extracted {total_files} files safely.", flush=True)
-    return dest_dir
+    return digests
 
-def sync_from_dir(src_dir, target_dir, keep_versions=True, dry_run=False, log_fp=None):
-    """Sync files with hash comparison and archive old versions."""
+def sync_from_dir(src_dir, target_dir, opts=None, log_fp=None, cache=None, src_digests=None,
+                  total_files=None):
+    """Sync files with hash comparison and archive old versions.
+
+    Files are hashed and copied on `opts.workers` threads; counters and log
+    lines are still aggregated in file order. `src_digests` (from
+    extract_zip) saves re-reading the source files; copies are hashed on
+    the fly, so each side is read at most once.
+
+    The source tree is enumerated lazily while syncing; `total_files` (the
+    member count from the ZIP) only sizes the progress bar.
+    """
+    src_digests = src_digests or {}
+    opts = opts or SyncOptions()
     src_dir = Path(expand_path(src_dir))
     target_dir = Path(expand_path(target_dir))
-    versions_dir = target_dir / ".old_versions"
+    versions_dir = target_dir / VERSIONS_DIRNAME
 
-    if keep_versions and not dry_run:
+    if opts.keep_versions and not opts.dry_run:
         ensure_dir(versions_dir)
+    moves = None
+    if not opts.dry_run:
+        KNOWN_DIRS.prepare(target_dir, src_digests)
+        if opts.detect_moves:
+            moves = MoveDetector(target_dir, cache, set(src_digests), opts)
 
-    all_files = []
-    for root, _, files in os.walk(src_dir):
-        for fn in files:
-            all_files.append(Path(root).joinpath(fn).relative_to(src_dir))
-
-    total_files = len(all_files)
-    copied = skipped = updated = errors = 0
+    counts = {"copied": 0, "skipped": 0, "updated": 0}
+    errors = 0
+    counter = 0
 
-    for counter, rel in enumerate(all_files, 1):
-        src_file = src_dir / rel
+    def sync_one(entry):
+        rel, src_file = entry
         dest_file = target_dir / rel
+        ensure_dir(dest_file.parent)
         try:
-            ensure_dir(dest_file.parent)
-            if dest_file.exists():
-                new_hash = sha256_file(src_file)
-                old_hash = sha256_file(dest_file)
-                if new_hash and old_hash and new_hash == old_hash:
-                    skipped += 1
-                else:
-                    if not dry_run:
-                        if keep_versions:
-                            ts = datetime.now().strftime("%Y%m%d-%H%M%S")
-                            archive_path = versions_dir / f"{rel}.{ts}"
-                            ensure_dir(archive_path.parent)
-                            shutil.move(str(dest_file), str(archive_path))
-                        shutil.copy2(src_file, dest_file)
-                    updated += 1
+            dest_st = dest_file.stat()
+        except FileNotFoundError:
+            dest_st = None
+        if dest_st is not None:
+            src_st = os.stat(src_file)
+            verdict = quick_verdict(src_st.st_size, src_st.st_mtime, dest_st, opts.compare_mode)
+            new_hash = src_digests.get(rel)
+            if verdict is None:
+                new_hash = new_hash or hash_file(src_file, opts.digest)
+                old_hash = file_digest(cache, dest_file, rel, opts.digest)
+                verdict = "same" if new_hash and old_hash and new_hash == old_hash else "changed"
+                if verdict == "same" and opts.compare_mode == "quick+verify" and not opts.dry_run:
+                    adopt_mtime(dest_file, rel, src_st.st_mtime, cache, opts.digest, new_hash)
+            if verdict == "same":
+                return "skipped"
+            if not opts.dry_run:
+                copy_into_place(src_file, dest_file, rel, new_hash)
+            return "updated"
+        if not opts.dry_run:
+            digest = src_digests.get(rel)
+            if not (moves and digest and reuse_moved(src_file, dest_file, rel, digest)):
+                copy_into_place(src_file, dest_file, rel, digest)
+        return "copied"
+
+    def reuse_moved(src_file, dest_file, rel, digest):
+        size = os.stat(src_file).st_size
+        for cand, cand_path, cand_st in moves.candidates(rel, size, opts.digest, digest):
+            with open(src_file, "rb") as f:
+                chunks = iter(lambda: f.read(COPIER.buffer_size), b"")
+                if not same_content(chunks, cand_path):
+                    continue
+            how = moves.relocate(cand, dest_file, cand_st)
+            if how is None:
+                return False
+            if how == "moved":
+                shutil.copystat(src_file, dest_file)
+            if cache is not None:
+                cache.store(rel, opts.digest, dest_file.stat(), digest)
+            safe_log_write(log_fp, f"{timestamp()} {how.upper()} {cand} -> {rel}\n")
+            return True
+        return False
+
+    def copy_into_place(src_file, dest_file, rel, digest):
+        # Copy next to the target and rename over it: the old copy is only
+        # archived once the new one is complete, and a hard-linked inode is
+        # never written through.
+        staging = staging_path(dest_file)
+        try:
+            if digest:
+                # Content was hashed during extraction, so the kernel can copy it.
+                COPIER.copy(src_file, staging, opts.fsync)
+                copied_digest = digest
             else:
-                if not dry_run:
-                    shutil.copy2(src_file, dest_file)
-                copied += 1
-        except Exception as e:
+                copied_digest = copy_file_hashed(src_file, staging, opts.digest, opts.fsync)
+        except BaseException:
+            staging.unlink(missing_ok=True)
+            raise
+        commit_staged(staging, dest_file, rel, versions_dir, opts.keep_versions, fsync=opts.fsync)
+        if cache is not None:
+            cache.store(rel, opts.digest, dest_file.stat(), copied_digest)
+
+    entries = scan_files(src_dir)
+    PROGRESS.start("Syncing", total_files or 0)
+    for counter, ((rel, _), outcome, err) in enumerate(parallel_map(sync_one, entries, opts.workers), 1):
+        if err is not None:
             errors += 1
-            safe_log_write(log_fp, f"{timestamp()} ERROR {rel}: {e}\n")
+            safe_log_write(log_fp, f"{timestamp()} ERROR {rel}: {err}\n")
+        else:
+            counts[outcome] += 1
+
+        PROGRESS.update(counter)
+    PROGRESS.finish()
+    if moves is not None:
+        moves.report(log_fp)
+
+    summary = {
+        "total": counter,
+        "copied": counts["copied"],
+        "skipped": counts["skipped"],
+        "updated": counts["updated"],
+        "errors": errors,
+        "moved": moves.moved if moves is not None else 0,
+    }
+    return summary
+
+# ------------------ Staged writes ------------------
+def staging_path(dest_file):
+    """Hidden temp name next to `dest_file`, on the same filesystem."""
+    return dest_file.with_name(f".{dest_file.name}.dbxpart")
+
+def stage_file(chunks, dest_file, hasher=None, fsync=False):
+    """Write `chunks` into a staging file next to `dest_file`; return its path.
+
+    `hasher` (hashlib-style) is fed the same chunks, and with `fsync` the
+    data is flushed to storage before the caller renames the file.
+    """
+    staging = staging_path(dest_file)
+    try:
+        with open(staging, "wb") as out:
+            for chunk in chunks:
+                out.write(chunk)
+                IO_STATS.add(written=len(chunk))
+                if hasher is not None:
+                    hasher.update(chunk)
+            if fsync:
+                out.flush()
+                FSYNCS.fsync(out.fileno())
+    except BaseException:
+        staging.unlink(missing_ok=True)
+        raise
+    return staging
+
+def commit_staged(staging, dest_file, rel, versions_dir, keep_versions, mtime=None, fsync=False):
+    """Atomically move a staged file into place, archiving the old copy.
+
+    Readers see either the old or the new file, never a partial one.
+    """
+    if mtime is not None:
+        os.utime(staging, (mtime, mtime))
+    # A new file cannot be left half-updated, only missing: no journal entry.
+    replacing = dest_file.exists()
+    op = JOURNAL.begin(rel) if replacing else None
+    if keep_versions and replacing:
+        archived = archive_version(dest_file, rel, versions_dir)
+        JOURNAL.note(op, archived=archived)
+    os.replace(staging, dest_file)
+    if fsync:
+        FSYNCS.fsync_path(dest_file.parent)
+    else:
+        FSYNCS.add(dest_file)
+    JOURNAL.done(op)
+
+class Journal:
+    """Write-ahead log of file replacements, finished or rolled back by recover()."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.fp = None
+        self.path = None
+        self.target_dir = None
+        self.open_ops = set()
+        self._next = 0
+
+    @property
+    def enabled(self):
+        return self.fp is not None
+
+    def pending(self, target_dir):
+        """Replacements an earlier run started but did not finish, by id."""
+        ops = {}
+        try:
+            with open(state_dir(target_dir) / JOURNAL_FILE, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # Torn last line of a killed run
+                    if "rel" in entry:
+                        ops[entry["id"]] = entry
+                    elif entry.get("done"):
+                        ops.pop(entry["id"], None)
+                    elif entry["id"] in ops:
+                        ops[entry["id"]].update(entry)
+        except FileNotFoundError:
+            pass
+        return ops
+
+    def recover(self, target_dir, keep_versions):
+        """Finish or roll back what an interrupted run left open.
+
+        Returns (replacements finished, old copies restored).
+        """
+        target_dir = Path(target_dir)
+        versions_dir = target_dir / VERSIONS_DIRNAME
+        finished = restored = 0
+        for op in self.pending(target_dir).values():
+            rel = op["rel"]
+            dest_file = target_dir / rel
+            staging = staging_path(dest_file)
+            archived = target_dir / op["archived"] if op.get("archived") else None
+            if staging.exists():
+                # The new copy was complete when logged: finish the replacement.
+                if keep_versions and dest_file.exists():
+                    archive_version(dest_file, rel, versions_dir)
+                os.replace(staging, dest_file)
+                finished += 1
+            elif not dest_file.exists() and archived is not None and archived.exists():
+                # Neither copy in place: bring the archived one back.
+                codec = version_codec(archived)
+                if codec:
+                    with open_codec(archived, codec) as f:
+                        staged = stage_file(iter(lambda: f.read(COPIER.buffer_size), b""), dest_file)
+                else:
+                    staged = staging_path(dest_file)
+                    COPIER.copy(archived, staged)
+                os.replace(staged, dest_file)
+                restored += 1
+        return finished, restored
+
+    def open(self, target_dir):
+        """Start a fresh journal; call recover() first."""
+        self.target_dir = Path(target_dir)
+        self.path = state_dir(target_dir) / JOURNAL_FILE
+        ensure_dir(self.path.parent)
+        self.fp = open(self.path, "w", encoding="utf-8")
+        self.open_ops = set()
+        self._next = 0
+        return self
+
+    def _write(self, entry, sync=False):
+        self.fp.write(json.dumps(entry) + "\n")
+        self.fp.flush()
+        if sync:
+            FSYNCS.fsync(self.fp.fileno())
+
+    def begin(self, rel):
+        """Log a replacement of `rel` and persist it; return its id."""
+        if self.fp is None:
+            return None
+        with self._lock:
+            self._next += 1
+            self._write({"id": self._next, "rel": Path(rel).as_posix()}, sync=True)
+            self.open_ops.add(self._next)
+            return self._next
+
+    def note(self, op, archived):
+        if op is None:
+            return
+        with self._lock:
+            self._write({"id": op, "archived": os.path.relpath(archived, self.target_dir)})
+
+    def done(self, op):
+        if op is None:
+            return
+        with self._lock:
+            self._write({"id": op, "done": True})
+            self.open_ops.discard(op)
+
+    def close(self):
+        """Close the journal, removing it unless a replacement is still open."""
+        if self.fp is None:
+            return
+        with self._lock:
+            self.fp.close()
+            self.fp = None
+            if not self.open_ops:
+                self.path.unlink(missing_ok=True)
+
+JOURNAL = Journal()
+
+# ------------------ Move detection ------------------
+def same_content(chunks, path, hasher=None):
+    """Whether streamed `chunks` equal the file at `path` byte for byte.
+
+    Stops reading at the first difference. `hasher` is fed the chunks and
+    holds the full digest when True is returned.
+    """
+    try:
+        with open(path, "rb") as f:
+            for chunk in chunks:
+                IO_STATS.add(read=len(chunk))
+                if f.read(len(chunk)) != chunk:
+                    return False
+                if hasher is not None:
+                    hasher.update(chunk)
+            return not f.read(1)
+    except OSError:
+        return False
+
+class MoveDetector:
+    """Reuse files already in the mirror for content that moved upstream.
 
-        print_progress_bar(counter, total_files, prefix="Syncing")
+    Orphans are renamed into place, other matches hard-linked.
+    """
+
+    def __init__(self, target_dir, cache, members=None, opts=None):
+        opts = opts or SyncOptions()
+        self.target_dir = Path(target_dir)
+        self.cache = cache
+        # Member file names; None if not known upfront (stream mode)
+        self.members = members
+        self.allow_move = opts.delete_mode != "keep" and members is not None
+        self.keep_dirs = member_dirs(members) if self.allow_move else set()
+        self.exclude = opts.delete_exclude
+        self._lock = threading.Lock()
+        self._claimed = set()
+        self.moved = self.linked = 0
+
+    def candidates(self, rel, size, algo=None, digest=None):
+        """Yield `(cand_rel, cand_path)` of existing files that may match."""
+        if self.cache is None or size == 0:
+            return
+        for cand in self.cache.find(size, algo, digest):
+            if cand == rel or cand in self._claimed:
+                continue
+            path = self.target_dir / cand
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if st.st_size == size:
+                yield cand, path, st
+
+    def relocate(self, cand, dest_file, cand_st):
+        """Move or hard-link verified candidate `cand` to `dest_file`.
+
+        `cand_st` is the candidate's stat from before it was verified; a
+        link to a file that was replaced meanwhile is undone. Returns
+        "moved", "linked" or None if the filesystem refused.
+        """
+        move = (self.allow_move and cand not in self.members
+                and not is_excluded(cand, self.exclude))
+        with self._lock:
+            if cand in self._claimed:
+                return None
+            if move:
+                self._claimed.add(cand)
+        src = self.target_dir / cand
+        try:
+            ensure_dir(dest_file.parent)
+            if move:
+                os.rename(src, dest_file)
+            else:
+                os.link(src, dest_file)
+                if os.stat(dest_file).st_ino != cand_st.st_ino:
+                    os.unlink(dest_file)
+                    return None
+        except OSError:
+            with self._lock:
+                self._claimed.discard(cand)
+            return None
+        with self._lock:
+            if move:
+                self.moved += 1
+            else:
+                self.linked += 1
+        if move:
+            if self.cache is not None:
+                self.cache.forget(cand)
+            remove_empty_parents(self.target_dir, cand, self.keep_dirs)
+        return "moved" if move else "linked"
+
+    def report(self, log_fp=None):
+        if self.moved or self.linked:
+            text = f"{self.moved} moved, {self.linked} hard-linked"
+            print(f"🔁 Reused existing files: {text}", flush=True)
+            safe_log_write(log_fp, f"{timestamp()} REUSED FILES: {text}\n")
+
+# ------------------ Zip-native sync ------------------
+def iter_member_chunks(z, zi):
+    """Yield the decompressed bytes of one member of an open ZipFile."""
+    with z.open(zi) as f:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK), b""):
+            yield chunk
+    IO_STATS.add(read=zi.compress_size)
+
+def sync_from_zip(zip_path, target_dir, opts=None, log_fp=None, cache=None, algo="crc32", start=0):
+    """Inflate the ZIP members that differ (by CRC32 or `algo`) and rename them into place.
+
+    Starts at member `start`; the summary also has "remaining" and "moved" counts.
+    """
+    opts = opts or SyncOptions()
+    target_dir = Path(expand_path(target_dir))
+    versions_dir = target_dir / VERSIONS_DIRNAME
+    if algo == "crc32":
+        print(f"🗜️  Syncing from ZIP: {zip_path}", flush=True)
+    else:
+        print(f"📦 Extracting changed files into target: {zip_path}", flush=True)
+
+    counts = {"copied": 0, "skipped": 0, "updated": 0}
+    errors = 0
+    with zipfile.ZipFile(str(zip_path), "r") as z:
+        members = []
+        for zi in z.infolist():
+            if not is_safe_member(zi.filename):
+                print(f"[!] Skipping suspicious file: {zi.filename}", flush=True)
+            elif zi.is_dir():
+                if not opts.dry_run:
+                    ensure_dir(target_dir / zi.filename)
+            else:
+                members.append(zi)
+        total_files = len(members)
+        if not opts.dry_run:
+            KNOWN_DIRS.prepare(target_dir, (zi.filename for zi in members))
+        moves = None
+        if opts.detect_moves and not opts.dry_run:
+            moves = MoveDetector(target_dir, cache, {zi.filename for zi in members}, opts)
+
+        def sync_one(zi):
+            rel = Path(zi.filename)
+            dest_file = target_dir / rel
+            mtime = zip_mtime(zi)
+            adopt = opts.compare_mode == "quick+verify" and mtime and not opts.dry_run
+            known = f"{zi.CRC:08x}" if algo == "crc32" else None
+            try:
+                st = dest_file.stat()
+            except FileNotFoundError:
+                st = None
+            verdict = "changed"
+            old = None
+            reason = "new file"
+            if st is not None:
+                verdict = quick_verdict(zi.file_size, mtime, st, opts.compare_mode)
+                reason = "size differs" if st.st_size != zi.file_size else "mtime differs"
+                if verdict is None and known:
+                    old = file_digest(cache, dest_file, rel, algo)
+                    same = old == known
+                    if same and adopt:
+                        adopt_mtime(dest_file, rel, mtime, cache, algo, known)
+                    verdict = "same" if same else "changed"
+                    reason = f"{algo} differs"
+                if verdict == "same":
+                    return "skipped"
+            outcome = "copied" if st is None else "updated"
+
+            if verdict is None:
+                # Hash-only pass: unchanged members are never written to disk
+                hasher = new_hasher(algo)
+                for chunk in iter_member_chunks(z, zi):
+                    hasher.update(chunk)
+                known = hasher.hexdigest()
+                old = file_digest(cache, dest_file, rel, algo)
+                if old == known:
+                    if adopt:
+                        adopt_mtime(dest_file, rel, mtime, cache, algo, known)
+                    return "skipped"
+                reason = f"{algo} differs"
+            if opts.dry_run:
+                PLAN.record(zi.filename, "create" if st is None else "update", zi.file_size, reason,
+                            st, old, known)
+                return outcome
+            if st is None and moves is not None:
+                if not known and next(moves.candidates(zi.filename, zi.file_size), None):
+                    # Same size as an existing file: the digest tells if it moved.
+                    hasher = new_hasher(algo)
+                    for chunk in iter_member_chunks(z, zi):
+                        hasher.update(chunk)
+                    known = hasher.hexdigest()
+                for cand, cand_path, cand_st in moves.candidates(zi.filename, zi.file_size,
+                                                                 algo, known):
+                    if not known or not same_content(iter_member_chunks(z, zi), cand_path):
+                        continue
+                    how = moves.relocate(cand, dest_file, cand_st)
+                    if how is None:
+                        break
+                    if how == "moved" and mtime:
+                        os.utime(dest_file, (mtime, mtime))
+                    if cache is not None:
+                        cache.store(rel, algo, dest_file.stat(), known)
+                    safe_log_write(log_fp, f"{timestamp()} {how.upper()} {cand} -> {rel}\n")
+                    return outcome
+
+            hasher = None if known else new_hasher(algo)
+            ensure_dir(dest_file.parent)
+            staged = stage_file(iter_member_chunks(z, zi), dest_file, hasher, opts.fsync)
+            digest = known or hasher.hexdigest()
+            commit_staged(staged, dest_file, rel, versions_dir, opts.keep_versions, mtime, opts.fsync)
+            if cache is not None:
+                cache.store(rel, algo, dest_file.stat(), digest)
+            return outcome
+
+        counter = start
+        PROGRESS.start("Syncing", total_files, initial=start)
+        todo = BUDGET.take(members[start:])
+        for counter, (zi, outcome, err) in enumerate(parallel_map(sync_one, todo, opts.workers), start + 1):
+            if err is not None:
+                errors += 1
+                safe_log_write(log_fp, f"{timestamp()} ERROR {zi.filename}: {err}\n")
+            else:
+                counts[outcome] += 1
+
+            PROGRESS.update(counter)
+        if counter < total_files:
+            PROGRESS.stop()
+        else:
+            PROGRESS.finish()
+    if moves is not None:
+        moves.report(log_fp)
 
     summary = {
         "total": total_files,
-        "copied": copied,
-        "skipped": skipped,
-        "updated": updated,
+        "copied": counts["copied"],
+        "skipped": counts["skipped"],
+        "updated": counts["updated"],
         "errors": errors,
+        "remaining": total_files - counter,
+        "moved": moves.moved if moves is not None else 0,
     }
-    print("\n📊 Sync Summary:")
-    for k, v in summary.items():
-        print(f"   {k:8}: {v}")
     return summary
 
+# ------------------ Pipeline ------------------
+class PipelineStage:
+    """Wall time of one pipeline stage, split into working and waiting."""
+
+    def __init__(self, name, threads=1):
+        self.name = name
+        self.threads = threads
+        self.elapsed = self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, elapsed=0.0, waited=0.0):
+        with self._lock:
+            self.elapsed += elapsed
+            self.waited += waited
+
+    @property
+    def busy(self):
+        return max(0.0, self.elapsed - self.waited)
+
+class Channel:
+    """Bounded queue between two pipeline stages.
+
+    A full channel blocks the producer (backpressure), so memory stays
+    bounded by the channel sizes. Time spent blocked is charged to the
+    stage passed to put()/iteration. The producer ends the stream with
+    close() or fail(exc); a consumer that gives up calls cancel() so the
+    producer stops instead of blocking forever.
+    """
+    _END = object()
+
+    def __init__(self, maxsize, consumer=None):
+        self._q = queue.Queue(maxsize)
+        self.consumer = consumer
+        self.cancelled = False
+        self.finished = False
+
+    def put(self, item, stage=None):
+        start = time.monotonic()
+        while not self.cancelled:
+            try:
+                self._q.put(item, timeout=0.2)
+                break
+            except queue.Full:
+                continue
+        if stage is not None:
+            stage.add(waited=time.monotonic() - start)
+        return not self.cancelled
+
+    def close(self):
+        self.put(self._END)
+
+    def fail(self, exc):
+        self.put(_ChannelError(exc))
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __iter__(self):
+        while True:
+            start = time.monotonic()
+            item = self._q.get()
+            if self.consumer is not None:
+                self.consumer.add(waited=time.monotonic() - start)
+            if item is self._END:
+                self.finished = True
+                return
+            if isinstance(item, _ChannelError):
+                self.finished = True
+                raise item.exc
+            yield item
+
+    def drain(self):
+        """Discard what is left so a blocked producer can finish."""
+        if self.finished:
+            return
+        try:
+            for _ in self:
+                pass
+        except Exception:
+            pass
+
+class _ChannelError:
+    def __init__(self, exc):
+        self.exc = exc
+
+def run_stage(stage, func, *args):
+    """Start `func(*args)` on a daemon thread, timing it as `stage`.
+
+    Returns the thread and a list that receives the exception, if any.
+    """
+    failure = []
+
+    def body():
+        start = time.monotonic()
+        try:
+            func(*args)
+        except BaseException as e:
+            failure.append(e)
+        finally:
+            stage.add(elapsed=time.monotonic() - start)
+
+    t = threading.Thread(target=body, name=f"dbx-{stage.name}", daemon=True)
+    t.start()
+    return t, failure
+
+def print_stage_times(stages):
+    """Per-stage busy/waiting time and the stage that limited throughput."""
+    print("\n⏱️  Pipeline stages (busy / waiting on queues):", flush=True)
+    for st in stages:
+        threads = f" ({st.threads} threads)" if st.threads > 1 else ""
+        print(f"   {st.name:9}: {st.busy:6.2f}s busy, {st.waited:6.2f}s waiting{threads}", flush=True)
+    slowest = max(stages, key=lambda st: st.busy / st.threads)
+    print(f"🐢 Bottleneck: {slowest.name}", flush=True)
+
+# ------------------ Streaming extraction ------------------
+ZIP_LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+ZIP_LOCAL_SIG = b"PK\x03\x04"
+ZIP_DESCRIPTOR_SIG = b"PK\x07\x08"
+ZIP_END_SIGS = (b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06", b"PK\x06\x08")
+STREAM_CHUNK = 64 * 1024
+
+class UnstreamableZip(Exception):
+    """A member's end cannot be found from its local header, so the stream cannot go on."""
+
+class ChunkReader:
+    """Byte reader on top of an iterator of chunks (e.g. an HTTP body)."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b""
+        self.consumed = 0
+
+    def _fill(self):
+        for chunk in self._chunks:
+            if chunk:
+                self._buf += chunk
+                return True
+        return False
+
+    def read_exact(self, n):
+        while len(self._buf) < n:
+            if not self._fill():
+                raise EOFError("Unexpected end of ZIP stream")
+        data, self._buf = self._buf[:n], self._buf[n:]
+        self.consumed += n
+        return data
+
+    def read_some(self, limit):
+        if not self._buf and not self._fill():
+            raise EOFError("Unexpected end of ZIP stream")
+        data, self._buf = self._buf[:limit], self._buf[limit:]
+        self.consumed += len(data)
+        return data
+
+    def unread(self, data):
+        self._buf = data + self._buf
+        self.consumed -= len(data)
+
+def _parse_local_header(reader, header):
+    """Build a ZipInfo from a local file header (signature already read)."""
+    (_, _, flags, method, dostime, dosdate, crc, csize, usize,
+     name_len, extra_len) = ZIP_LOCAL_HEADER.unpack(header)
+    raw_name = reader.read_exact(name_len)
+    extra = reader.read_exact(extra_len)
+    name = raw_name.decode("utf-8" if flags & 0x800 else "cp437")
+    date_time = ((dosdate >> 9) + 1980, (dosdate >> 5) & 0xF, dosdate & 0x1F,
+                 dostime >> 11, (dostime >> 5) & 0x3F, (dostime & 0x1F) * 2)
+    zi = zipfile.ZipInfo(name, date_time)
+    zi.flag_bits, zi.compress_type, zi.CRC = flags, method, crc
+    zi.compress_size, zi.file_size = csize, usize
+
+    zip64 = False
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, size = struct.unpack_from("<HH", extra, pos)
+        if tag == 0x0001:
+            zip64 = True
+            values = list(struct.unpack_from(f"<{size // 8}Q", extra, pos + 4))
+            if zi.file_size == 0xFFFFFFFF and values:
+                zi.file_size = values.pop(0)
+            if zi.compress_size == 0xFFFFFFFF and values:
+                zi.compress_size = values.pop(0)
+        pos += 4 + size
+    return zi, zip64
+
+def _member_data(reader, zi, zip64):
+    """Yield the decompressed bytes of one member and verify its CRC32.
+
+    A rejected member's bytes are consumed before raising ValueError, so the
+    stream stays aligned on the next header. If its size is only in a data
+    descriptor after the data, that is impossible and UnstreamableZip is
+    raised instead.
+    """
+    has_descriptor = zi.flag_bits & 0x08
+    if zi.flag_bits & 0x01:
+        reason = "encrypted ZIP members are not supported"
+    elif zi.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        reason = f"unsupported compression method {zi.compress_type}"
+    elif zi.compress_type == zipfile.ZIP_STORED and has_descriptor:
+        reason = "stored member without sizes"
+    else:
+        reason = None
+    if reason and has_descriptor:
+        raise UnstreamableZip(f"{zi.filename}: {reason} cannot be streamed; use SYNC_MODE=zip")
+    if reason:
+        remaining = zi.compress_size
+        while remaining:
+            remaining -= len(reader.read_some(min(remaining, STREAM_CHUNK)))
+        raise ValueError(f"{zi.filename}: {reason}")
+
+    crc = 0
+    if zi.compress_type == zipfile.ZIP_STORED:
+        remaining = zi.compress_size
+        while remaining:
+            data = reader.read_some(min(remaining, STREAM_CHUNK))
+            remaining -= len(data)
+            crc = zlib.crc32(data, crc)
+            yield data
+    else:
+        d = zlib.decompressobj(-15)
+        remaining = None if has_descriptor else zi.compress_size
+        while not d.eof:
+            if remaining == 0:
+                raise zipfile.BadZipFile(f"{zi.filename}: truncated deflate data")
+            buf = reader.read_some(STREAM_CHUNK if remaining is None else min(remaining, STREAM_CHUNK))
+            if remaining is not None:
+                remaining -= len(buf)
+            # Bound the memory used by highly compressible members.
+            while buf and not d.eof:
+                data = d.decompress(buf, STREAM_CHUNK)
+                buf = d.unconsumed_tail
+                if data:
+                    crc = zlib.crc32(data, crc)
+                    yield data
+        if d.unused_data:
+            reader.unread(d.unused_data)
+
+    if has_descriptor:
+        head = reader.read_exact(4)
+        if head == ZIP_DESCRIPTOR_SIG:
+            head = reader.read_exact(4)
+        zi.CRC = struct.unpack("<I", head)[0]
+        if zip64:
+            zi.compress_size, zi.file_size = struct.unpack("<QQ", reader.read_exact(16))
+        else:
+            zi.compress_size, zi.file_size = struct.unpack("<II", reader.read_exact(8))
+    if crc != zi.CRC:
+        raise zipfile.BadZipFile(f"{zi.filename}: CRC32 mismatch")
+
+def iter_stream_members(chunks):
+    """Parse a ZIP sequentially from its local file headers.
+
+    Yields `(ZipInfo, data_iterator)` per member as the bytes arrive. Data
+    the consumer leaves unread is skipped before the next member is parsed.
+    Iteration stops at the central directory; a member that cannot be
+    skipped raises UnstreamableZip.
+    """
+    reader = ChunkReader(chunks)
+    while True:
+        sig = reader.read_exact(4)
+        if sig in ZIP_END_SIGS:
+            return
+        if sig != ZIP_LOCAL_SIG:
+            raise zipfile.BadZipFile(f"Unexpected ZIP record {sig!r} at offset {reader.consumed - 4}")
+        zi, zip64 = _parse_local_header(reader, sig + reader.read_exact(ZIP_LOCAL_HEADER.size - 4))
+        data = _member_data(reader, zi, zip64)
+        yield zi, data
+        try:
+            for _ in data:
+                pass
+        except (ValueError, zipfile.BadZipFile, zlib.error):
+            pass  # Already reported to the consumer of `data`.
+
+def _start_staging(staging, old, common):
+    """Open a staging file seeded with the first `common` bytes of `old`."""
+    out = open(staging, "wb")
+    if old is not None:
+        old.seek(0)
+        while common:
+            buf = old.read(min(common, 1024 * 1024))
+            out.write(buf)
+            IO_STATS.add(read=len(buf), written=len(buf))
+            common -= len(buf)
+    return out
+
+def write_if_changed(chunks, dest_file, dry_run=False, fsync=False, base=None):
+    """Compare streamed content against `dest_file`, writing only on change.
+
+    The new bytes are compared in lockstep with the existing file; as long
+    as they match nothing is written. At the first difference a staging
+    file next to `dest_file` is started with the common prefix. Returns the
+    staging path (None if unchanged, or the sentinel True in dry-run mode).
+    With `base`, that file is compared against instead of `dest_file`.
+    """
+    staging = staging_path(dest_file)
+    base = base or dest_file
+    old = open(base, "rb") if base.exists() else None
+    pos = 0
+    out = None
+    try:
+        for chunk in chunks:
+            if out is None and old is not None:
+                IO_STATS.add(read=len(chunk))
+                if old.read(len(chunk)) == chunk:
+                    pos += len(chunk)
+                    continue
+            if out is None:
+                if dry_run:
+                    for _ in chunks:
+                        pass
+                    return True
+                out = _start_staging(staging, old, pos)
+                old = None
+            out.write(chunk)
+            IO_STATS.add(written=len(chunk))
+        if out is None:
+            if old is not None and not old.read(1):
+                return None  # Identical content.
+            if dry_run:
+                return True
+            # New empty file, or the old file had extra trailing bytes.
+            out = _start_staging(staging, old, pos)
+        if fsync:
+            out.flush()
+            FSYNCS.fsync(out.fileno())
+        out.close()
+        return staging
+    except BaseException:
+        if out is not None:
+            out.close()
+            staging.unlink(missing_ok=True)
+        raise
+    finally:
+        if old is not None:
+            old.close()
+
+def _stream_member(zi, data, target_dir, opts, cache, moves=None):
+    """Compare stage for one streamed member: decide and stage changes.
+
+    Returns `(outcome, staged, store)`; `staged` is the staging path to
+    commit (True in dry-run mode) and `store` says whether the target's
+    CRC32 should be recorded in the cache.
+    """
+    dry_run = opts.dry_run
+    rel = Path(zi.filename)
+    dest_file = target_dir / rel
+    if not dry_run:
+        ensure_dir(dest_file.parent)
+    try:
+        st = dest_file.stat()
+    except FileNotFoundError:
+        st = None
+    # Without a data descriptor the local header already carries
+    # size and CRC32; with one, only the timestamp is known upfront.
+    sized = not zi.flag_bits & 0x08
+    mtime = zip_mtime(zi)
+    verdict = "changed"
+    if st is not None:
+        verdict = quick_verdict(zi.file_size if sized else None, mtime, st, opts.compare_mode)
+    if verdict == "same":
+        return "skipped", None, False
+    adopt = opts.compare_mode == "quick+verify" and mtime and not dry_run
+    if (verdict is None and sized and cache is not None
+            and cache.lookup(rel, "crc32", st) == f"{zi.CRC:08x}"):
+        cache.hits += 1
+        if adopt:
+            adopt_mtime(dest_file, rel, mtime, cache, "crc32", f"{zi.CRC:08x}")
+        return "skipped", None, False
+    if st is None and sized and moves is not None:
+        for cand, cand_path, cand_st in moves.candidates(zi.filename, zi.file_size, "crc32",
+                                                         f"{zi.CRC:08x}"):
+            # Compare against the candidate; a mismatch still ends up staged.
+            staged = write_if_changed(data, dest_file, fsync=opts.fsync, base=cand_path)
+            if staged is not None:
+                return "copied", staged, True
+            if moves.relocate(cand, dest_file, cand_st):
+                return "copied", None, True
+            staged = staging_path(dest_file)
+            COPIER.copy(cand_path, staged, opts.fsync)
+            return "copied", staged, True
+    if verdict == "changed":
+        staged = True if dry_run else stage_file(data, dest_file, fsync=opts.fsync)
+    else:
+        staged = write_if_changed(data, dest_file, dry_run, opts.fsync)
+        if staged is None and adopt:
+            os.utime(dest_file, (mtime, mtime))
+    if staged is None:
+        return "skipped", None, not dry_run
+    return ("copied" if st is None else "updated"), staged, not dry_run
+
+def sync_stream(url, target_dir, validators=None, opts=None, log_fp=None, cache=None, seen=None):
+    """Download the ZIP and sync its members while the bytes arrive.
+
+    Nothing but changed files touches the disk: there is no local copy of
+    the archive and no temporary extraction directory. Returns
+    `(summary, validators)`; `summary` is None if the remote archive is
+    unchanged since the last sync. The names of all safe members are added
+    to the `seen` set, if given.
+
+    The work runs as a pipeline of stages connected by bounded channels:
+    download (HTTP reader) -> inflate (ZIP decoder, sequential by format)
+    -> compare (`opts.workers` threads, lockstep compare and staging)
+    -> commit (renames, version archive and cache, in archive order).
+    """
+    opts = opts or SyncOptions()
+    target_dir = Path(expand_path(target_dir))
+    versions_dir = target_dir / VERSIONS_DIRNAME
+    safe_url = strip_ansi_and_control(url)
+    print(f"📥 Streaming ZIP from {safe_url}", flush=True)
+
+    if not validate_url(safe_url):
+        raise ValueError(f"Invalid URL: {safe_url}")
+
+    headers = conditional_headers(safe_url, validators)
+    with requests.get(safe_url, stream=True, timeout=60, headers=headers) as r:
+        if r.status_code == 304:
+            print("✅ Remote ZIP not modified since last sync.", flush=True)
+            return None, validators
+        r.raise_for_status()
+        current = response_validators(safe_url, r.headers)
+        if validators_match(validators, current):
+            print("✅ Remote ZIP unchanged since last sync.", flush=True)
+            return None, validators
+        total_size = int(r.headers.get("content-length", 0))
+
+        stages = [PipelineStage("download"), PipelineStage("inflate"),
+                  PipelineStage("compare", opts.workers), PipelineStage("commit")]
+        download, inflate, compare, commit = stages
+        chunk_q = Channel(opts.queue_chunks, consumer=inflate)
+        # Members whose compare result has not been committed yet
+        pending = Channel(opts.workers * 2, consumer=commit)
+        counts = {"total": 0, "copied": 0, "skipped": 0, "updated": 0, "errors": 0}
+        received = [0]
+        # The member list is unknown until the end, so files can only be linked
+        moves = None
+        if opts.detect_moves and not opts.dry_run:
+            moves = MoveDetector(target_dir, cache, None, opts)
+
+        def read_http():
+            try:
+                for chunk in r.iter_content(chunk_size=STREAM_CHUNK):
+                    received[0] += len(chunk)
+                    if not chunk_q.put(chunk, download):
+                        return
+            except BaseException as e:
+                chunk_q.fail(e)
+                raise
+            chunk_q.close()
+
+        def compare_member(zi, data):
+            start = time.monotonic()
+            try:
+                return _stream_member(zi, data, target_dir, opts, cache, moves)
+            finally:
+                data.drain()
+                compare.add(elapsed=time.monotonic() - start)
+
+        def commit_results():
+            try:
+                commit_all()
+            except BaseException:
+                pending.cancel()
+                raise
+
+        def commit_all():
+            for zi, future in pending:
+                rel = Path(zi.filename)
+                dest_file = target_dir / rel
+                start = time.monotonic()
+                try:
+                    outcome, staged, store = future.result()
+                    commit.add(waited=time.monotonic() - start)
+                    if staged is not None and not opts.dry_run:
+                        commit_staged(staged, dest_file, rel, versions_dir, opts.keep_versions,
+                                      zip_mtime(zi), opts.fsync)
+                    if store and cache is not None:
+                        cache.store(rel, "crc32", dest_file.stat(), f"{zi.CRC:08x}")
+                    counts[outcome] += 1
+                except (OSError, ValueError, zipfile.BadZipFile, zlib.error) as e:
+                    counts["errors"] += 1
+                    safe_log_write(log_fp, f"{timestamp()} ERROR {rel}: {e}\n")
+                PROGRESS.update(min(received[0], total_size))
+
+        if total_size:
+            PROGRESS.start("Syncing", total_size, unit="bytes")
+        reader, _ = run_stage(download, read_http)
+        committer, commit_failed = run_stage(commit, commit_results)
+        pool = ThreadPoolExecutor(max_workers=opts.workers, thread_name_prefix="dbx-compare")
+        start = time.monotonic()
+        try:
+            for zi, data in iter_stream_members(chunk_q):
+                if pending.cancelled:
+                    break
+                if not is_safe_member(zi.filename):
+                    print(f"[!] Skipping suspicious file: {zi.filename}", flush=True)
+                    continue
+                if seen is not None:
+                    seen.add(zi.filename)
+                if zi.is_dir():
+                    if not opts.dry_run:
+                        ensure_dir(target_dir / zi.filename)
+                    continue
+                counts["total"] += 1
+                member = Channel(16, consumer=compare)
+                pending.put((zi, pool.submit(compare_member, zi, member)), inflate)
+                try:
+                    for chunk in data:
+                        member.put(chunk, inflate)
+                except (ValueError, zipfile.BadZipFile, zlib.error) as e:
+                    member.fail(e)  # Reported by the compare stage.
+                except BaseException as e:
+                    member.fail(e)
+                    raise
+                else:
+                    member.close()
+            pending.close()
+        except BaseException:
+            chunk_q.cancel()
+            pending.fail(RuntimeError("ZIP stream aborted"))
+            raise
+        finally:
+            inflate.add(elapsed=time.monotonic() - start)
+            committer.join()
+            pool.shutdown(wait=True)
+            chunk_q.cancel()
+            reader.join()
+        for failure in commit_failed:
+            raise failure
+        PROGRESS.finish()
+
+    summary = {key: counts[key] for key in ("total", "copied", "skipped", "updated", "errors")}
+    print_stage_times(stages)
+    if moves is not None:
+        moves.report(log_fp)
+    safe_log_write(log_fp, f"{timestamp()} STAGES: " + ", ".join(
+        f"{st.name}={st.busy:.2f}s/{st.waited:.2f}s" for st in stages) + "\n")
+    return summary, current
+
+# ------------------ Deletions ------------------
+def zip_member_names(zip_path):
+    """Names of the safe members in the ZIP's central directory."""
+    with zipfile.ZipFile(str(zip_path), "r") as z:
+        return {name for name in z.namelist() if is_safe_member(name)}
+
+def is_excluded(rel, patterns):
+    """Whether `rel` matches a DELETE_EXCLUDE glob (full path or file name)."""
+    name = posixpath.basename(rel)
+    return any(fnmatch.fnmatchcase(rel, pat) or fnmatch.fnmatchcase(name, pat) for pat in patterns)
+
+def member_dirs(members):
+    """All directories implied by the ZIP member names (without trailing /)."""
+    dirs = set()
+    for name in members:
+        parent = name.rstrip("/") if name.endswith("/") else posixpath.dirname(name)
+        while parent and parent not in dirs:
+            dirs.add(parent)
+            parent = posixpath.dirname(parent)
+    return dirs
+
+def remove_empty_parents(target_dir, rel, keep_dirs):
+    """Remove the directories above `rel` that are now empty and not in `keep_dirs`."""
+    parent = posixpath.dirname(rel)
+    while parent and parent not in keep_dirs:
+        try:
+            os.rmdir(Path(target_dir) / parent)
+        except OSError:
+            break
+        KNOWN_DIRS.forget(Path(target_dir) / parent)
+        parent = posixpath.dirname(parent)
+
+def is_member_file(target_dir, rel, path, folded):
+    """Whether `path` is a member's file under another case of its name.
+
+    On case-insensitive storage (Android shared storage) a member renamed
+    only in case is written through the existing file, which keeps its
+    old name. `folded` maps casefolded member names to member names.
+    """
+    name = folded.get(rel.casefold())
+    if name is None:
+        return False
+    try:
+        return os.path.samefile(path, target_dir / name)
+    except OSError:
+        return False
+
+def prune_tombstones(target_dir, member_files):
+    """Drop the tombstones of paths that are back in the ZIP."""
+    tombstones_path = state_dir(target_dir) / TOMBSTONES_FILE
+    tombstones = load_json(tombstones_path, {})
+    kept = {rel: info for rel, info in tombstones.items() if rel not in member_files}
+    if len(kept) != len(tombstones):
+        save_json(tombstones_path, kept)
+
+def remove_orphans(target_dir, members, opts, log_fp=None, cache=None, created=0):
+    """Archive or delete mirrored files that are no longer in the ZIP.
+
+    `members` holds the ZIP's member names. Files matching
+    `opts.delete_exclude` are never touched, and nothing at all is removed
+    if more than `opts.delete_max_percent` of the mirrored files would go
+    (e.g. a truncated or wrong archive). `created` files were added by this
+    sync and are left out of that share, which is taken of the mirror as it
+    was before. Every removal leaves a tombstone
+    in the state dir, dropped again when the path reappears in the ZIP.
+    Returns the number of files removed (or that would be, in dry-run).
+    """
+    target_dir = Path(expand_path(target_dir))
+    member_files = {name for name in members if not name.endswith("/")}
+
+    total = 0
+    orphans = []
+    folded = None
+    for rel, path in iter_target_files(target_dir):
+        if is_excluded(rel, opts.delete_exclude):
+            continue
+        total += 1
+        if rel not in member_files:
+            if folded is None:
+                folded = {name.casefold(): name for name in member_files}
+            if not is_member_file(target_dir, rel, path, folded):
+                orphans.append((rel, path))
+    if not opts.dry_run:
+        prune_tombstones(target_dir, member_files)
+    if not orphans:
+        return 0
+    total = max(total - created, len(orphans))
+    if len(orphans) * 100 > total * opts.delete_max_percent:
+        print(f"[!] {len(orphans)} of {total} mirrored files are not in the ZIP, more than "
+              f"DELETE_MAX_PERCENT={opts.delete_max_percent}%; nothing was removed.", flush=True)
+        safe_log_write(log_fp, f"{timestamp()} DELETE ABORTED: {len(orphans)} of {total} files orphaned\n")
+        return 0
+
+    verb = opts.delete_mode
+    print(f"🗑️  {len(orphans)} files no longer in the ZIP ({verb}"
+          f"{', dry run' if opts.dry_run else ''})", flush=True)
+    if opts.dry_run:
+        for rel, path in orphans:
+            safe_log_write(log_fp, f"{timestamp()} WOULD {verb.upper()} {rel}\n")
+            st = path.stat()
+            PLAN.record(rel, verb, st.st_size, "not in ZIP", st)
+        return len(orphans)
+    return remove_files(target_dir, orphans, verb, members, log_fp, cache)
+
+def remove_files(target_dir, orphans, verb, members, log_fp=None, cache=None):
+    """Archive or delete the (rel, path) `orphans`, leaving tombstones.
+
+    `verb` is "archive" or "delete"; `members` are the ZIP's member names.
+    Returns the number of files removed.
+    """
+    versions_dir = target_dir / VERSIONS_DIRNAME
+    member_files = {name for name in members if not name.endswith("/")}
+    keep_dirs = member_dirs(members)
+    tombstones_path = state_dir(target_dir) / TOMBSTONES_FILE
+    tombstones = {rel: info for rel, info in load_json(tombstones_path, {}).items()
+                  if rel not in member_files}
+    removed = 0
+    for rel, path in orphans:
+        try:
+            archived = None
+            if verb == "archive":
+                archived = archive_version(path, rel, versions_dir).relative_to(versions_dir).as_posix()
+            else:
+                path.unlink()
+        except OSError as e:
+            safe_log_write(log_fp, f"{timestamp()} ERROR removing {rel}: {e}\n")
+            continue
+        removed += 1
+        if cache is not None:
+            cache.forget(rel)
+        tombstones[rel] = {"deleted": timestamp(), "mode": verb, "archive": archived}
+        safe_log_write(log_fp, f"{timestamp()} {verb.upper()}D {rel}\n")
+        # Drop directories emptied by the removal, unless the ZIP has them.
+        remove_empty_parents(target_dir, rel, keep_dirs)
+    save_json(tombstones_path, tombstones)
+    return removed
+
+# ------------------ Plan / apply ------------------
+PLAN_FORMATS = ("json", "jsonl")
+PLAN_ACTIONS = ("create", "update", "archive", "delete")
+
+class ChangePlan:
+    """Changes a dry run would make, collected for the `plan` command.
+
+    Each change holds path, action, size, old/new digest and reason, plus
+    the size and mtime the target had, which `apply` checks to notice a
+    file that changed after planning. Not started, record() is a no-op.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.changes = None
+
+    @property
+    def enabled(self):
+        return self.changes is not None
+
+    def start(self):
+        self.changes = []
+
+    def record(self, path, action, size, reason, old_st=None, old_digest=None, new_digest=None):
+        if self.changes is None:
+            return
+        change = {"path": Path(path).as_posix(), "action": action, "size": size,
+                  "old_digest": old_digest, "new_digest": new_digest, "reason": reason,
+                  "old_size": old_st.st_size if old_st else None,
+                  "old_mtime": old_st.st_mtime if old_st else None}
+        with self._lock:
+            self.changes.append(change)
+
+    def write(self, path, header, fmt="json"):
+        """Save the plan as one JSON document or as JSON lines (header first)."""
+        changes = sorted(self.changes, key=lambda c: (PLAN_ACTIONS.index(c["action"]), c["path"]))
+        path = Path(expand_path(path))
+        ensure_dir(path.parent)
+        with open(path, "w", encoding="utf-8") as f:
+            if fmt == "jsonl":
+                f.write(json.dumps(header) + "\n")
+                for change in changes:
+                    f.write(json.dumps(change) + "\n")
+            else:
+                json.dump(dict(header, changes=changes), f, indent=2)
+        return len(changes)
+
+PLAN = ChangePlan()
+
+def plan_header(url, target_dir, zip_path, validators, algo):
+    """First part of a plan: where its changes come from and apply to."""
+    return {"plan": 1, "created": timestamp(), "url": url,
+            "target": str(Path(expand_path(target_dir))),
+            "zip": str(Path(zip_path).resolve()) if zip_path else None,
+            "zip_size": Path(zip_path).stat().st_size if zip_path else None,
+            "validators": validators, "algo": algo}
+
+def write_plan(args, header):
+    """Write PLAN to the file given on the command line and say how to apply it."""
+    fmt = args.format or ("jsonl" if args.output.endswith(".jsonl") else "json")
+    count = PLAN.write(args.output, header, fmt)
+    print(f"📝 Wrote {count} planned changes to {args.output}; "
+          f"run 'apply --plan {args.output}' to execute them", flush=True)
+
+def load_plan(path):
+    """Read a plan written by ChangePlan.write; return (header, changes)."""
+    with open(expand_path(path), encoding="utf-8") as f:
+        text = f.read()
+    try:
+        plan = json.loads(text)
+        return plan, plan.pop("changes")
+    except ValueError:  # JSON lines
+        lines = [json.loads(line) for line in text.splitlines() if line.strip()]
+        return lines[0], lines[1:]
+
+def apply_plan(plan_path, target_dir, opts, log_fp=None, cache=None):
+    """Execute a reviewed plan from its downloaded ZIP, without diffing again.
+
+    A change is skipped as "stale" if the target no longer looks the way
+    it did when planned (size/mtime, or a new file that now exists). The
+    plan may have been edited, so unsafe paths are refused as errors and
+    removals of DELETE_EXCLUDE files are skipped.
+    Returns (summary, validators to remember or None, ZIP path).
+    """
+    target_dir = Path(expand_path(target_dir))
+    versions_dir = target_dir / VERSIONS_DIRNAME
+    header, changes = load_plan(plan_path)
+    if header.get("plan") != 1:
+        raise ValueError(f"{plan_path} is not a plan written by the plan command")
+    if Path(header["target"]) != target_dir:
+        raise ValueError(f"plan is for {header['target']}, not {target_dir}")
+    zip_path = Path(header["zip"]) if changes and header.get("zip") else None
+    if changes and (zip_path is None or not zip_path.exists()
+                    or zip_path.stat().st_size != header["zip_size"]):
+        raise FileNotFoundError(f"ZIP of the plan is gone or changed ({zip_path}); run plan again")
+    print(f"📝 Applying {len(changes)} planned changes from {plan_path}", flush=True)
+
+    counts = {"copied": 0, "updated": 0, "deleted": 0, "stale": 0, "errors": 0}
+
+    def is_stale(change, dest_file):
+        try:
+            st = dest_file.stat()
+        except FileNotFoundError:
+            return change["action"] != "create"
+        return (change["action"] == "create" or st.st_size != change["old_size"]
+                or st.st_mtime != change["old_mtime"])
+
+    fresh = []
+    for change in changes:
+        rel = change["path"]
+        if (change["action"] not in PLAN_ACTIONS or not rel or not is_safe_member(rel)
+                or Path(rel).parts[0] in MIRROR_INTERNAL):
+            counts["errors"] += 1
+            safe_log_write(log_fp, f"{timestamp()} REFUSED {change['action']} {rel}: unsafe change\n")
+        elif change["action"] in ("archive", "delete") and is_excluded(rel, opts.delete_exclude):
+            safe_log_write(log_fp, f"{timestamp()} SKIPPED {change['action']} {rel}: DELETE_EXCLUDE\n")
+        elif is_stale(change, target_dir / rel):
+            counts["stale"] += 1
+            safe_log_write(log_fp, f"{timestamp()} STALE {change['action']} {change['path']}\n")
+        else:
+            fresh.append(change)
+    writes = [c for c in fresh if c["action"] in ("create", "update")]
+    if opts.dry_run:
+        for change in fresh:
+            key = {"create": "copied", "update": "updated"}.get(change["action"], "deleted")
+            counts[key] += 1
+        return dict(total=len(changes), **counts), None, None
+
+    members = []
+    if changes:
+        with zipfile.ZipFile(str(zip_path), "r") as z:
+            members = z.namelist()
+            KNOWN_DIRS.prepare(target_dir, (c["path"] for c in writes))
+
+            def write_one(change):
+                rel = change["path"]
+                zi = z.getinfo(rel)
+                dest_file = target_dir / rel
+                ensure_dir(dest_file.parent)
+                hasher = new_hasher(header["algo"]) if change["new_digest"] is None else None
+                staged = stage_file(iter_member_chunks(z, zi), dest_file, hasher, opts.fsync)
+                commit_staged(staged, dest_file, rel, versions_dir, opts.keep_versions,
+                              zip_mtime(zi), opts.fsync)
+                if cache is not None:
+                    digest = change["new_digest"] or hasher.hexdigest()
+                    cache.store(rel, header["algo"], dest_file.stat(), digest)
+                return "copied" if change["action"] == "create" else "updated"
+
+            PROGRESS.start("Syncing", len(writes))
+            results = parallel_map(write_one, writes, opts.workers)
+            for counter, (change, outcome, err) in enumerate(results, 1):
+                if err is not None:
+                    counts["errors"] += 1
+                    safe_log_write(log_fp, f"{timestamp()} ERROR {change['path']}: {err}\n")
+                else:
+                    counts[outcome] += 1
+                PROGRESS.update(counter)
+            PROGRESS.finish()
+    for verb in ("archive", "delete"):
+        batch = [(c["path"], target_dir / c["path"]) for c in fresh if c["action"] == verb]
+        if batch:
+            removed = remove_files(target_dir, batch, verb, members, log_fp, cache)
+            counts["deleted"] += removed
+            counts["errors"] += len(batch) - removed
+    validators = header.get("validators") if not counts["stale"] else None
+    return dict(total=len(changes), **counts), validators, zip_path
+
 # ------------------ Main ------------------
-def main():
+def parse_args(argv=None):
+    """Parse command line options and maintenance subcommands."""
+    parser = argparse.ArgumentParser(description="Mirror a public Dropbox ZIP into a local folder.")
+    parser.add_argument("--dry-run", action="store_true", help="simulate without writing files")
+    parser.add_argument("--force", action="store_true",
+                        help="download even if the remote ZIP looks unchanged")
+    sub = parser.add_subparsers(dest="command", metavar="command")
+    sub.add_parser("sync", help="download and sync (default)")
+    bench = sub.add_parser("bench", help="measure the MB/s of each digest backend on this device")
+    bench.add_argument("--size", type=int, default=64, metavar="MB", help="data hashed per backend")
+    cache = sub.add_parser("cache", help="maintain the file-state cache in TARGET_DIR/.mirror_state")
+    cache.add_argument("action", choices=("rebuild", "validate"),
+                       help="rebuild: re-hash all files; validate: check and drop bad entries")
+    restore = sub.add_parser("restore", help="list or restore archived versions of a file")
+    restore.add_argument("path", help="file path relative to TARGET_DIR")
+    restore.add_argument("--list", action="store_true", help="only list the archived versions")
+    restore.add_argument("--at", metavar="TS",
+                         help="version timestamp or prefix (YYYYmmdd-HHMMSS); default: newest")
+    restore.add_argument("--output", metavar="FILE",
+                         help="write the version here instead of over the mirrored file")
+    sub.add_parser("prune", help="apply the VERSIONS_* retention settings to .old_versions now")
+    plan = sub.add_parser("plan", help="download and diff, then write the changes to a plan file")
+    plan.add_argument("--output", default="plan.json", metavar="FILE", help="plan file (default: plan.json)")
+    plan.add_argument("--format", choices=PLAN_FORMATS,
+                      help="json or jsonl (one change per line); default: from the file suffix")
+    apply = sub.add_parser("apply", help="execute a plan written by the plan command")
+    apply.add_argument("--plan", required=True, metavar="FILE", help="plan file to execute")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "bench":
+        return digest_benchmark(max(1, args.size))
     print("🟢 Starting Dropbox ZIP Mirror Sync", flush=True)
     print(f"📄 Config file: {ENV_PATH}", flush=True)
 
@@ -277,10 +3308,101 @@ def main():
     keep_versions = cfg.get("KEEP_VERSIONS", "yes").lower().startswith("y")
     dry_run = cfg.get("DRY_RUN", "no").lower() in ("1", "true", "yes", "y")
     log_path = expand_path(cfg.get("LOG_PATH", str(script_dir / "sync.log")))
+    connections = cfg_int(cfg, "DOWNLOAD_CONNECTIONS", 1, minimum=1)
+    workers = resolve_workers(cfg_value(cfg, "SYNC_WORKERS", "auto"))
+    queue_chunks = cfg_int(cfg, "PIPELINE_QUEUE", 64, minimum=1)
+    delete_mode = cfg_value(cfg, "DELETE_MODE", "keep").lower()
+    versions_store = cfg_value(cfg, "VERSIONS_STORE", "files").lower()
+    delete_exclude = tuple(p.strip() for p in cfg_value(cfg, "DELETE_EXCLUDE", "").split(",") if p.strip())
+    delete_max_percent = cfg_int(cfg, "DELETE_MAX_PERCENT", 50, minimum=0)
+    detect_moves = cfg_value(cfg, "MOVE_DETECTION", "yes").lower().startswith("y")
+    try:
+        retention = (cfg_int(cfg, "VERSIONS_KEEP_COUNT", 0, minimum=0),
+                     cfg_int(cfg, "VERSIONS_MAX_AGE_DAYS", 0, minimum=0),
+                     parse_size(cfg_value(cfg, "VERSIONS_MAX_BYTES", "0")))
+    except ValueError:
+        print("[!] ERROR: VERSIONS_MAX_BYTES must be a size like 500M or 2G", flush=True)
+        return 1
+    prune_budget = cfg_int(cfg, "PRUNE_TIME_BUDGET", 2, minimum=0)
+    max_runtime = cfg_int(cfg, "MAX_RUNTIME", 0, minimum=0)
+    compress = cfg_value(cfg, "VERSIONS_COMPRESS", "none").lower()
+    compress_workers = cfg_int(cfg, "COMPRESS_WORKERS", 1, minimum=1)
+    compress_budget = cfg_int(cfg, "COMPRESS_TIME_BUDGET", 10, minimum=0)
+    compare_mode = cfg_value(cfg, "COMPARE_MODE", "hash").lower()
+    if compare_mode not in COMPARE_MODES:
+        print(f"[!] ERROR: COMPARE_MODE must be one of {', '.join(COMPARE_MODES)}", flush=True)
+        return 1
+    staging = cfg_value(cfg, "STAGING", "target").lower()
+    durability = cfg_value(cfg, "DURABILITY", "none").lower()
+    for key, value, allowed in (("STAGING", staging, STAGING_MODES),
+                                ("DURABILITY", durability, DURABILITY_MODES),
+                                ("DELETE_MODE", delete_mode, DELETE_MODES),
+                                ("VERSIONS_STORE", versions_store, VERSIONS_STORES),
+                                ("VERSIONS_COMPRESS", compress, COMPRESS_MODES)):
+        if value not in allowed:
+            print(f"[!] ERROR: {key} must be one of {', '.join(allowed)}", flush=True)
+            return 1
+    if delete_mode == "archive" and not keep_versions:
+        print("[!] ERROR: DELETE_MODE=archive needs KEEP_VERSIONS=yes "
+              "(use DELETE_MODE=delete to remove files for good)", flush=True)
+        return 1
+    module, package = OPTIONAL_CODECS.get(compress, (gzip, None))
+    if module is None:
+        hint = f"'pip install {package}'" if package else "a Python built with lzma"
+        print(f"Warning: VERSIONS_COMPRESS={compress} needs {hint}, using gzip", flush=True)
+        compress = "gzip"
+    digest = cfg_value(cfg, "DIGEST_ALGO", "sha256").lower()
+    if digest in OPTIONAL_DIGESTS and digest not in DIGEST_BACKENDS:
+        print(f"Warning: DIGEST_ALGO={digest} needs 'pip install {OPTIONAL_DIGESTS[digest]}', "
+              "using sha256", flush=True)
+        digest = "sha256"
+    if digest not in DIGEST_BACKENDS:
+        print(f"[!] ERROR: DIGEST_ALGO must be one of {', '.join(DIGEST_BACKENDS)}", flush=True)
+        return 1
+    sync_mode = cfg_value(cfg, "SYNC_MODE", "extract").lower()
+    if sync_mode not in SYNC_MODES:
+        print(f"[!] ERROR: SYNC_MODE must be one of {', '.join(SYNC_MODES)}", flush=True)
+        return 1
+    progress = cfg_value(cfg, "PROGRESS", "auto").lower()
+    if progress not in PROGRESS_MODES:
+        print(f"[!] ERROR: PROGRESS must be one of {', '.join(PROGRESS_MODES)}", flush=True)
+        return 1
+    PROGRESS.configure(progress, cfg_int(cfg, "PROGRESS_RATE", 4, minimum=1))
+    copy_method = cfg_value(cfg, "COPY_METHOD", "auto").lower()
+    if copy_method not in ("auto",) + COPY_METHODS:
+        print(f"[!] ERROR: COPY_METHOD must be one of auto, {', '.join(COPY_METHODS)}", flush=True)
+        return 1
+    COPIER.configure(copy_method, cfg_int(cfg, "COPY_BUFFER_KB", 1024, minimum=4) * 1024)
+    FSYNCS.configure(durability, cfg_int(cfg, "DURABILITY_BATCH", 64, minimum=1))
+
+    if args.command == "cache":
+        if args.action == "rebuild":
+            return cache_rebuild(target_dir, digest)
+        return cache_validate(target_dir)
+    if args.command == "restore":
+        return restore_version(target_dir, args.path, args.at, args.output, args.list, versions_store)
+    if args.command == "prune":
+        return prune_command(target_dir, retention, dry_run or args.dry_run)
 
-    if "--dry-run" in sys.argv:
+    if args.dry_run:
         dry_run = True
         print("⚡ Dry-run mode enabled via CLI flag", flush=True)
+    if args.command == "plan":
+        # A dry run that records its decisions; the ZIP is kept for apply.
+        dry_run = True
+        PLAN.start()
+        if sync_mode == "stream" or staging == "tempdir":
+            sync_mode = "zip" if sync_mode == "stream" else sync_mode
+            staging = "target"
+    resumable = args.command in (None, "sync") and not dry_run
+    if max_runtime and resumable:
+        # Stopping and resuming needs the ZIP on disk and in-place syncing.
+        BUDGET.configure(max_runtime)
+        sync_mode = "zip" if sync_mode == "stream" else sync_mode
+        staging = "target"
+    force = args.force
+    if force:
+        print("⚡ Forcing full download (ignoring remembered validators)", flush=True)
 
     if not url or "dropbox.com" not in url:
         print("[!] ERROR: Missing or invalid DROPBOX_URL", flush=True)
@@ -295,35 +3417,197 @@ def main():
     print(f"🌐 URL: {url}", flush=True)
     print(f"📂 Target: {target_dir}", flush=True)
     print(f"💭 Dry run: {dry_run}", flush=True)
+    print(f"🧵 Sync workers: {workers}", flush=True)
+    opts = SyncOptions(keep_versions=keep_versions, dry_run=dry_run, workers=workers,
+                       compare_mode=compare_mode, digest=digest, durability=durability,
+                       queue_chunks=queue_chunks, delete_mode=delete_mode,
+                       delete_exclude=delete_exclude, delete_max_percent=delete_max_percent,
+                       detect_moves=detect_moves)
 
     # ----------------- Core workflow -----------------
+    cache = pruner = None
     try:
         with open(log_path, "a", encoding="utf-8") as log_fp:
             safe_log_write(log_fp, f"{timestamp()} === RUN START ===\n")
 
-            # Step 1: Download ZIP
-            zip_path = download_zip(url, download_path)
-            safe_log_write(log_fp, f"{timestamp()} Downloaded: {zip_path}\n")
+            remote_state = state_dir(target_dir) / REMOTE_STATE_FILE
+            saved = None if force else load_json(remote_state)
+            resume = None
+            if resumable and not force and sync_mode != "stream":
+                resume = load_resume(target_dir)
+                staging = "target" if resume else staging
+            zip_path = tmpdir = None
+            IO_STATS.reset()
+            FSYNCS.reset()
+            KNOWN_DIRS.reset()
+            COPIER.reset()
+            if sync_mode == "stream":
+                PROGRESS.plan(["Syncing"])
+            elif sync_mode == "extract" and staging == "tempdir":
+                PROGRESS.plan(["Downloading", "Extracting", "Syncing"])
+            else:
+                PROGRESS.plan(["Downloading", "Syncing"])
+            cache = FileStateCache.open(target_dir, readonly=dry_run)
+            versions_dir = Path(target_dir) / VERSIONS_DIRNAME
+            if dry_run:
+                if (versions_dir / VERSIONS_INDEX_FILE).exists():
+                    VERSIONS.open(versions_dir)  # Only to report what pruning would reclaim
+            elif keep_versions or (any(retention) and versions_dir.is_dir()):
+                VERSIONS.open(versions_dir, cache, versions_store)
+            if dry_run:
+                if JOURNAL.pending(target_dir):
+                    print("Warning: an interrupted run left files half-updated; "
+                          "the next real run repairs them", flush=True)
+            else:
+                finished, restored = JOURNAL.recover(target_dir, keep_versions)
+                if finished or restored:
+                    print(f"🩹 Recovered an interrupted run: {finished} updates finished, "
+                          f"{restored} old copies put back", flush=True)
+                    safe_log_write(log_fp, f"{timestamp()} RECOVERED: finished={finished} "
+                                           f"restored={restored}\n")
+                JOURNAL.open(target_dir)
+            if VERSIONS.enabled and any(retention) and prune_budget:
+                pruner = BackgroundPrune(VERSIONS, retention, prune_budget, dry_run)
+                pruner.start()
+
+            if args.command == "apply":
+                # Steps 1-4 as reviewed: no download and no diff
+                summary, validators, zip_path = apply_plan(args.plan, target_dir, opts, log_fp, cache)
+            elif sync_mode == "stream":
+                # Steps 1-3 in a single pass: members are synced as they arrive
+                members = set()
+                summary, validators = sync_stream(url, target_dir, saved, opts, log_fp, cache, members)
+            else:
+                # Step 1: Download ZIP (skipped entirely if the remote is unchanged)
+                zip_path, validators = download_zip(url, download_path,
+                                                    resume["validators"] if resume else saved, connections)
+                summary = None
+                if resume and zip_path is None:
+                    # The ZIP kept by a run that ran out of time is still current.
+                    zip_path, validators = Path(resume["zip"]), resume["validators"]
+                    print(f"⏯️  Continuing the last run at file {resume['position']}", flush=True)
+                elif resume:
+                    resume = None  # The remote changed: start over with the new ZIP
+            start = resume["position"] if resume else 0
+            if summary is None and zip_path is None:
+                safe_log_write(log_fp, f"{timestamp()} Remote unchanged, nothing to do\n")
+                if pruner is not None:
+                    pruner.report(log_fp)
+                if compress != "none" and VERSIONS.enabled and not dry_run:
+                    compress_old_versions(compress, compress_workers, compress_budget, log_fp)
+                if PLAN.enabled:
+                    write_plan(args, plan_header(url, target_dir, None, None, digest))
+                safe_log_write(log_fp, f"{timestamp()} === RUN END ===\n")
+                print("🎉 Mirror already up to date.", flush=True)
+                return 0
+
+            if summary is not None:
+                pass  # Synced while streaming, or replayed from a plan
+            elif sync_mode == "zip":
+                safe_log_write(log_fp, f"{timestamp()} Downloaded: {zip_path}\n")
+
+                # Steps 2-3: Diff against the central directory, inflate changes only
+                summary = sync_from_zip(zip_path, target_dir, opts, log_fp, cache, start=start)
+            elif sync_mode == "extract" and staging == "target":
+                safe_log_write(log_fp, f"{timestamp()} Downloaded: {zip_path}\n")
+
+                # Steps 2-3: Inflate members next to their target, rename changed ones into place
+                summary = sync_from_zip(zip_path, target_dir, opts, log_fp, cache, algo=digest, start=start)
+            elif sync_mode == "extract":
+                safe_log_write(log_fp, f"{timestamp()} Downloaded: {zip_path}\n")
+
+                # Step 2: Extract ZIP
+                tmpdir = Path(tempfile.mkdtemp(prefix="dbx_sync_"))
+                src_digests = extract_zip(zip_path, tmpdir, digest)
+                safe_log_write(log_fp, f"{timestamp()} Extracted to: {tmpdir}\n")
 
-            # Step 2: Extract ZIP
-            tmpdir = Path(tempfile.mkdtemp(prefix="dbx_sync_"))
-            extract_zip(zip_path, tmpdir)
-            safe_log_write(log_fp, f"{timestamp()} Extracted to: {tmpdir}\n")
+                # Step 3: Sync files
+                summary = sync_from_dir(tmpdir, target_dir, opts, log_fp, cache, src_digests,
+                                        total_files=len(src_digests))
 
-            # Step 3: Sync files
-            summary = sync_from_dir(tmpdir, target_dir, keep_versions, dry_run, log_fp)
+            remaining = summary.pop("remaining", 0)
+            # Files this run added to the mirror; moved ones were there before.
+            moved = summary.pop("moved", 0)
+            created = 0 if dry_run else summary["copied"] - moved
+            if resume:
+                # Errors of the earlier parts count too, so the validators are not saved.
+                summary["errors"] += resume.get("errors", 0)
+                created += resume.get("created", 0)
+            if remaining:
+                # Check the progress in; deletions and validators wait for the last part.
+                save_json(state_dir(target_dir) / RESUME_FILE, {
+                    "zip": str(Path(zip_path).resolve()), "zip_size": Path(zip_path).stat().st_size,
+                    "validators": validators, "position": summary["total"] - remaining,
+                    "errors": summary["errors"], "created": created, "stopped": timestamp()})
+                safe_log_write(log_fp, f"{timestamp()} STOPPED: MAX_RUNTIME, {remaining} files left\n")
+            elif resumable:
+                (state_dir(target_dir) / RESUME_FILE).unlink(missing_ok=True)
+
+            # Step 4: Remove what is no longer in the ZIP
+            if delete_mode != "keep" and args.command != "apply" and not remaining:
+                if zip_path:
+                    members = zip_member_names(zip_path)
+                deleted = remove_orphans(target_dir, members, opts, log_fp, cache, created)
+                summary["deleted"] = deleted
+                summary["errors"] = summary.pop("errors")  # Keep errors last
+            FSYNCS.flush()
+            print_summary(summary)
+            summary["bytes_read"] = IO_STATS.read
+            summary["bytes_written"] = IO_STATS.written
+            summary["fsync_calls"] = FSYNCS.calls
+            summary["fsync_seconds"] = round(FSYNCS.seconds, 3)
             safe_log_write(log_fp, f"{timestamp()} SYNC SUMMARY: {summary}\n")
+            print(f"💾 Digest cache: {cache.hits} reused, {cache.misses} computed", flush=True)
+            print(f"💽 Local I/O: {IO_STATS.read / 1e6:.1f} MB read, "
+                  f"{IO_STATS.written / 1e6:.1f} MB written", flush=True)
+            if FSYNCS.calls:
+                print(f"🔒 fsync: {FSYNCS.summary()}", flush=True)
+            if COPIER.used:
+                print(f"📋 Copy method: {COPIER.summary()}", flush=True)
+                safe_log_write(log_fp, f"{timestamp()} COPY METHOD: {COPIER.summary()}\n")
+            if pruner is not None:
+                pruner.report(log_fp)
+            if compress != "none" and VERSIONS.enabled and not dry_run:
+                compress_old_versions(compress, compress_workers, compress_budget, log_fp)
+
+            if PLAN.enabled:
+                algo = "crc32" if sync_mode == "zip" else digest
+                write_plan(args, plan_header(url, target_dir, zip_path, validators, algo))
+
+            # Only remember the archive once it has been mirrored completely,
+            # so that a failed or simulated run is retried next time.
+            if not dry_run and summary["errors"] == 0 and validators and not remaining:
+                save_json(remote_state, validators)
+            if remaining:
+                print(f"⏸️  MAX_RUNTIME reached: {remaining} of {summary['total']} files left, "
+                      "the next run continues here", flush=True)
 
-            # Step 4: Cleanup
-            if Path(zip_path).exists():
+            # Step 5: Cleanup (a plan, a run to be continued or a failed apply keeps its ZIP)
+            retry_apply = args.command == "apply" and summary["errors"]
+            if (zip_path and Path(zip_path).exists() and not PLAN.enabled and not remaining
+                    and not retry_apply):
                 Path(zip_path).unlink()
-            shutil.rmtree(tmpdir)
+            if tmpdir:
+                shutil.rmtree(tmpdir)
             safe_log_write(log_fp, f"{timestamp()} Cleanup complete\n")
             safe_log_write(log_fp, f"{timestamp()} === RUN END ===\n")
 
+    except BudgetExhausted:
+        PROGRESS.stop()
+        print("⏸️  MAX_RUNTIME reached while downloading, the next run resumes the download", flush=True)
+        return 0
     except Exception as e:
+        PROGRESS.stop()
         print(f"[!] ERROR: {e}", flush=True)
         return 2
+    finally:
+        if pruner is not None:
+            pruner.join()
+        FSYNCS.flush()  # Persist what was written before an error, too
+        JOURNAL.close()
+        VERSIONS.close()
+        if cache is not None:
+            cache.close()
 
     print("🎉 Dropbox Mirror Sync finished successfully!", flush=True)
     return 0